@@ -0,0 +1,519 @@
+"""
+Library interface of the converter, for embedding it within another program. Nothing is
+printed: every file and every annotation gets a structured result instead.
+
+    results = convert_many(['a.pdf', 'b.pdf'], jobs=4)
+    results = await convert_many_async(['a.pdf', 'b.pdf'])
+"""
+import os
+import logging
+
+from boox_annot_reader import Annot, annotation_path, group_by_page, iter_page_annotations
+from stats import NULL_STATS, Stats
+from fsutil import backup, clone_file, unshare
+
+_LOGGER = logging.getLogger(__name__)
+AUTHOR = 'Tin Lai'
+HIGHLIGHT_COLOR = (1, 1, 0.4)
+
+# status of an annotation
+ADDED = 'added'
+DUPLICATE = 'duplicate'
+NOT_FOUND = 'not_found'
+MULTIPLE_INSTANCES = 'multiple_instances'
+PAGE_NOT_FOUND = 'page_not_found'
+
+# status of a file
+CONVERTED = 'converted'
+EXPORTED = 'exported'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+# match method of the highlights read from a sidecar
+METHOD_SIDECAR = 'sidecar'
+# same as helper.COMPACT_PRECISION, without importing it
+COMPACT_PRECISION = 2
+
+
+class AnnotationResult:
+    """
+    Represent the outcome of a single annotation: its page (0-based), text and comment, the
+    quadpoints of every highlighted line (in pdf coordinates), how its text was matched
+    (exact, fallback or sidecar) and its status. ADDED means that the highlight was added to
+    the output, be it the pdf or a sidecar.
+    """
+    __slots__ = ('page', 'text', 'comment', 'quads', 'method', 'status', 'error')
+
+    def __init__(self, annot, status, quads=None, method=None, error=None):
+        self.page = annot.page
+        self.text = annot.text
+        self.comment = annot.comment
+        self.quads = quads
+        self.method = method
+        self.status = status
+        self.error = error
+
+    def as_dict(self):
+        """Return the result as a json serialisable dict."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class FileResult:
+    """
+    Represent the outcome of a file: the written output (None unless converted), its status,
+    the results of its annotations, its stats, the error that made it fail, the bytes saved
+    by a compact output and the warnings about options that could not be honoured.
+    """
+    __slots__ = ('input_file', 'output', 'status', 'annotations', 'stats', 'error',
+                 'bytes_saved', 'warnings')
+
+    def __init__(self, input_file, status, output=None, annotations=(), stats=None,
+                 error=None, bytes_saved=0, warnings=()):
+        self.input_file = input_file
+        self.status = status
+        self.output = output
+        self.annotations = list(annotations)
+        self.stats = stats
+        self.error = error
+        self.bytes_saved = bytes_saved
+        self.warnings = list(warnings)
+
+    @property
+    def added(self):
+        """Return the number of highlights added to the file."""
+        return sum(result.status == ADDED for result in self.annotations)
+
+    def as_dict(self):
+        """Return the result as a json serialisable dict."""
+        result = {name: getattr(self, name) for name in self.__slots__}
+        result['annotations'] = [annot.as_dict() for annot in self.annotations]
+        return result
+
+
+def release_if_exceeded(searcher, ceiling, stats):
+    """Release the memory held by the given searcher if the process exceeds the ceiling."""
+    if ceiling.exceeded():
+        searcher.release_memory()
+        stats.incr('memory_releases')
+
+
+def _open_match_cache(match_cache):
+    """
+    Return the given match cache, opening it if it is a path, and whether it was opened here
+    (hence must be closed once the file is done).
+    """
+    if match_cache is None or not isinstance(match_cache, str):
+        return match_cache, False
+    from match_cache import MatchCache
+    return MatchCache(match_cache), True
+
+
+def _resolve_pages(searcher, page_groups, page_count, results, stats, ceiling=None,
+                   match_cache=None):
+    """
+    Search the annotations of every page group, unless their match is in the match cache.
+    Return the plan of page number -> [(annot, quadpoints or exception, method, style)], the
+    annotations of the pages that do not exist being added to results.
+    """
+    plan = {}
+    for i, page_annots in page_groups:
+        if i >= page_count:
+            results.extend(AnnotationResult(annot, PAGE_NOT_FOUND) for annot in page_annots)
+            continue
+        # resolve all annotations of this page in one batch
+        texts = [_annot.text for _annot in page_annots]
+        if match_cache is None:
+            matches = searcher.get_page_quadpoints(i, texts)
+        else:
+            matches = match_cache.page_quadpoints(searcher, i, texts, stats)
+        plan.setdefault(i, []).extend((annot, points, method, None)
+                                      for annot, (points, method) in zip(page_annots, matches))
+        if ceiling is not None:
+            searcher.release_page(i)
+            release_if_exceeded(searcher, ceiling, stats)
+    return plan
+
+
+def _shard_pages(page_groups, shards):
+    """
+    Split the page groups into at most shards runs of consecutive annotated pages, with about
+    as many annotations each. The groups of a same page are joined in order, so that each
+    page is searched by a single worker.
+    """
+    pages = {}
+    for i, page_annots in page_groups:
+        pages.setdefault(i, []).extend(page_annots)
+    size = max(1, -(-sum(len(page_annots) for page_annots in pages.values()) // shards))
+    result, current, count = [], [], 0
+    for i in sorted(pages):
+        current.append((i, pages[i]))
+        count += len(pages[i])
+        if count >= size:
+            result.append(current)
+            current, count = [], 0
+    if current:
+        result.append(current)
+    return result
+
+
+# the pdf searched by a worker process of a page-sharded search, opened once per worker
+_worker_searcher = None
+
+
+def _init_page_worker(input_file):
+    """Open the pdf searched by this worker process, which only reads it."""
+    global _worker_searcher
+    from pdf_text_search import PDFTextSearch
+    _worker_searcher = PDFTextSearch(input_file)
+
+
+def _resolve_shard(shard, page_count, ceiling, match_cache, with_stats):
+    """
+    Search the page groups of a shard within a worker process (see _resolve_pages). Return
+    its plan, the results of its pages that do not exist and its stats.
+    """
+    stats = Stats() if with_stats else NULL_STATS
+    _worker_searcher.stats = stats
+    results = []
+    match_cache, own_match_cache = _open_match_cache(match_cache)
+    try:
+        plan = _resolve_pages(_worker_searcher, shard, page_count, results, stats, ceiling,
+                              match_cache)
+    finally:
+        if own_match_cache:
+            match_cache.close()
+    return plan, results, stats.as_dict()
+
+
+def _plan_pages(input_file, searcher, page_groups, page_count, results, stats, ceiling=None,
+                match_cache=None, page_jobs=1):
+    """
+    Return the plan of the given page groups (see _resolve_pages). If page_jobs is more than
+    1, the annotated pages are sharded between as many worker processes, which each open the
+    pdf and search their pages; the plan is the same as a search within this process.
+    """
+    if page_jobs > 1:
+        # a few shards per worker, so that a worker done early takes another one
+        shards = _shard_pages(page_groups, page_jobs * 4)
+        if len(shards) > 1:
+            return _resolve_pages_parallel(input_file, shards, page_count, results, stats,
+                                           ceiling, match_cache, page_jobs)
+        page_groups = shards[0] if shards else []
+    match_cache, own_match_cache = _open_match_cache(match_cache)
+    try:
+        return _resolve_pages(searcher, page_groups, page_count, results, stats, ceiling,
+                              match_cache)
+    finally:
+        if own_match_cache:
+            match_cache.close()
+
+
+def _resolve_pages_parallel(input_file, shards, page_count, results, stats, ceiling,
+                            match_cache, page_jobs):
+    """Search the given shards of page groups with a pool of page_jobs worker processes."""
+    from concurrent.futures import ProcessPoolExecutor
+    if match_cache is not None and not isinstance(match_cache, str):
+        # each worker opens its own connection
+        match_cache = match_cache.path
+    plan = {}
+    with ProcessPoolExecutor(max_workers=page_jobs, initializer=_init_page_worker,
+                             initargs=(input_file,)) as executor:
+        futures = [executor.submit(_resolve_shard, shard, page_count, ceiling, match_cache,
+                                   stats.enabled)
+                   for shard in shards]
+        with stats.timer('parallel_search'):
+            for future in futures:
+                shard_plan, shard_results, shard_stats = future.result()
+                plan.update(shard_plan)
+                results.extend(shard_results)
+                stats.merge(shard_stats)
+    return plan
+
+
+def _sidecar_plan(path, page_count, results):
+    """
+    Return the plan of page number -> [(annot, quadpoints, method, style)] of the highlights
+    of the given sidecar, the highlights of the pages that do not exist being added to results.
+    """
+    from sidecar import read_sidecar
+    from helper import RectBatch
+    plan = {}
+    for highlight in read_sidecar(path):
+        annot = Annot(highlight.page, highlight.text, highlight.comment)
+        if highlight.page >= page_count:
+            results.append(AnnotationResult(annot, PAGE_NOT_FOUND, method=METHOD_SIDECAR))
+            continue
+        # the rect (x0, y0, x1, y1) of every quad (x0, y1, x1, y1, x0, y0, x1, y0)
+        points = RectBatch([(quad[0], quad[5], quad[2], quad[1]) for quad in highlight.quads])
+        plan.setdefault(highlight.page, []).append(
+            (annot, points, METHOD_SIDECAR, (highlight.author, highlight.color)))
+    return plan
+
+
+def convert_file(input_file, use_new_file=False, backup_file=True, backend='fitz',
+                 incremental=False, annotations=None, stats=NULL_STATS, normalise=True,
+                 cache=None, max_memory=None, author=AUTHOR, color=HIGHLIGHT_COLOR,
+                 sidecar=None, match_cache=None, compact=False, precision=COMPACT_PRECISION,
+                 page_jobs=1):
+    """
+    Convert a given file's annotations. Return its FileResult, the annotation results being
+    in page order. If incremental, the new highlights are appended to the file as a new
+    revision instead of rewriting it, hence no bak file is needed. If annotations are given,
+    only those are converted instead of the annotation file's. The time spent in every stage
+    and the outcomes are recorded in stats. If normalise, the internal structure of the
+    written pdf is fixed up (not for incremental updates). If a document cache is given, the
+    pages already indexed in an earlier conversion are reused. If max_memory (in bytes) is
+    given, every page is released as soon as it is searched, and the caches of the pdf
+    library are dropped whenever the process grows over max_memory. If a sidecar file is
+    given (see export_file), its highlights are applied instead of searching the annotations.
+    If a match cache (see match_cache.MatchCache, or the path of one) is given, the annotations
+    already matched against the same page content are not searched again. If compact, the
+    highlights share their color and author objects, and their coordinates are rounded to
+    precision decimals; the bytes saved (an estimate) are given by the FileResult. If
+    page_jobs is more than 1, the pages are searched by as many worker processes, for a single
+    large pdf; the highlights are still written by this process, in page order.
+    """
+    if sidecar is not None:
+        if not os.path.isfile(sidecar):
+            _LOGGER.debug("Expected sidecar file does not exists.")
+            return FileResult(input_file, SKIPPED)
+    elif annotations is None and not os.path.isfile(annotation_path(input_file)):
+        _LOGGER.debug("Expected annotation file does not exists.")
+        return FileResult(input_file, SKIPPED)
+    from backends import open_backend
+    from pdf_text_search import TextNotFoundException, MultipleInstancesException
+    if use_new_file:
+        output = 'result.' + os.path.basename(input_file)
+    else:
+        output = os.path.basename(input_file)
+    output = os.path.join(os.path.dirname(input_file), output)
+    warnings = []
+    if incremental and backend != 'fitz':
+        warnings.append("Backend '{}' cannot save incrementally, rewriting the entire "
+                        "file.".format(backend))
+        incremental = False
+    ceiling = None
+    if max_memory is not None:
+        if backend != 'fitz':
+            # pdfrw holds the object graph of the entire file in memory
+            warnings.append("Backend '{}' cannot bound its memory, using 'fitz' "
+                            "instead.".format(backend))
+            backend = 'fitz'
+        from memory import MemoryCeiling
+        ceiling = MemoryCeiling(max_memory)
+    # the pdf that is opened and written to, the annotations stay those of input_file
+    source = input_file
+    linked = False
+    if incremental:
+        if use_new_file:
+            # the revision is appended to the new file
+            clone_file(input_file, output, link=False)
+            source = output
+        else:
+            # the revision is appended in place, which must not reach a hardlink backup
+            unshare(input_file)
+    elif backup_file:
+        # the input is only replaced when it is the output
+        backup(input_file, link=not use_new_file)
+        linked = not use_new_file
+
+    try:
+        page_cache = cache.lookup(input_file) if cache is not None else None
+        with stats.timer('open'):
+            pdf = open_backend(source, backend, stats=stats, page_cache=page_cache,
+                               compact=compact, precision=precision)
+        fitz_pdf = pdf.searcher
+        # plan of page number -> [(annot, quadpoints, method, style)], only annotated pages are
+        # ever loaded. each page is searched as soon as its annotations are read.
+        results = []
+        if sidecar is not None:
+            plan = _sidecar_plan(sidecar, pdf.page_count, results)
+        else:
+            if annotations is None:
+                page_groups = iter_page_annotations(input_file, stats=stats)
+            else:
+                page_groups = group_by_page(annotations)
+            plan = _plan_pages(source, fitz_pdf, page_groups, pdf.page_count, results, stats,
+                               ceiling, match_cache, page_jobs)
+
+        added = 0
+        for i in sorted(plan):
+            # the highlights of a page are written at once
+            batch = []
+            for _annot, points, method, style in plan[i]:
+                if isinstance(points, MultipleInstancesException):
+                    results.append(AnnotationResult(_annot, MULTIPLE_INSTANCES, method=method,
+                                                    error=str(points)))
+                    continue
+                if isinstance(points, TextNotFoundException):
+                    results.append(AnnotationResult(_annot, NOT_FOUND, method=method,
+                                                    error=str(points)))
+                    continue
+                quads = points.quadpoints()
+                # check to see if this annotation exists already
+                if fitz_pdf.points_exist(page_num=i, points=points):
+                    stats.incr('duplicates_skipped')
+                    results.append(AnnotationResult(_annot, DUPLICATE, quads, method))
+                else:
+                    highlight_author, highlight_color = style or (None, None)
+                    # later duplicates of this annotation are detected against it
+                    fitz_pdf.register_points(i, points)
+                    batch.append((points, highlight_color or color, highlight_author or author,
+                                  _annot.comment))
+                    results.append(AnnotationResult(_annot, ADDED, quads, method))
+            if batch:
+                with stats.timer('add_highlight'):
+                    pdf.add_highlights(i, batch)
+                stats.incr('highlights_added', len(batch))
+                added += len(batch)
+            if ceiling is not None:
+                release_if_exceeded(fitz_pdf, ceiling, stats)
+
+        if incremental and not added:
+            _LOGGER.info("No new highlights, leaving the file untouched.")
+        else:
+            with stats.timer('save'):
+                pdf.save(output, incremental=incremental, normalise=normalise)
+            if cache is not None:
+                # the highlights do not change the pages, the written file has the same ones
+                cache.alias(output, page_cache)
+        bytes_saved = pdf.bytes_saved
+        if bytes_saved:
+            stats.incr('compact_bytes_saved', bytes_saved)
+        pdf.close()
+        if cache is not None:
+            cache.trim()
+        results.sort(key=lambda result: result.page)
+        return FileResult(input_file, CONVERTED, output, results, stats=stats.as_dict(),
+                          bytes_saved=bytes_saved, warnings=warnings)
+    except BaseException:
+        if linked:
+            # the input was not replaced, it must not stay a hardlink of its bak
+            unshare(input_file)
+        raise
+
+
+def export_file(input_file, sidecar_format='json', annotations=None, stats=NULL_STATS,
+                cache=None, author=AUTHOR, color=HIGHLIGHT_COLOR, match_cache=None,
+                page_jobs=1):
+    """
+    Resolve a given file's annotations like convert_file, but write the highlights to a
+    sidecar file of the given format ('json' or 'xfdf') next to the pdf, which is left
+    untouched. The highlights that the pdf already has are not exported. Return its
+    FileResult, whose output is the sidecar.
+    """
+    if annotations is None and not os.path.isfile(annotation_path(input_file)):
+        _LOGGER.debug("Expected annotation file does not exists.")
+        return FileResult(input_file, SKIPPED)
+    from pdf_text_search import PDFTextSearch, TextNotFoundException, MultipleInstancesException
+    from sidecar import SidecarHighlight, sidecar_path, write_sidecar
+    page_cache = cache.lookup(input_file) if cache is not None else None
+    with stats.timer('open'):
+        searcher = PDFTextSearch(input_file, stats=stats, page_cache=page_cache)
+    results = []
+    if annotations is None:
+        page_groups = iter_page_annotations(input_file, stats=stats)
+    else:
+        page_groups = group_by_page(annotations)
+    plan = _plan_pages(input_file, searcher, page_groups, searcher.doc.pageCount, results,
+                       stats, match_cache=match_cache, page_jobs=page_jobs)
+
+    highlights = []
+    for i in sorted(plan):
+        for _annot, points, method, _style in plan[i]:
+            if isinstance(points, MultipleInstancesException):
+                results.append(AnnotationResult(_annot, MULTIPLE_INSTANCES, method=method,
+                                                error=str(points)))
+            elif isinstance(points, TextNotFoundException):
+                results.append(AnnotationResult(_annot, NOT_FOUND, method=method,
+                                                error=str(points)))
+            elif searcher.points_exist(page_num=i, points=points):
+                stats.incr('duplicates_skipped')
+                results.append(AnnotationResult(_annot, DUPLICATE, points.quadpoints(), method))
+            else:
+                # later duplicates of this annotation are detected against it
+                searcher.register_points(i, points)
+                quads = points.quadpoints()
+                highlights.append(SidecarHighlight(i, quads, _annot.text, _annot.comment,
+                                                   author, color))
+                stats.incr('highlights_exported')
+                results.append(AnnotationResult(_annot, ADDED, quads, method))
+    searcher.doc.close()
+    output = sidecar_path(input_file, sidecar_format)
+    with stats.timer('save'):
+        write_sidecar(output, input_file, highlights)
+    if cache is not None:
+        cache.trim()
+    results.sort(key=lambda result: result.page)
+    return FileResult(input_file, EXPORTED, output, results, stats=stats.as_dict())
+
+
+def _convert_job(input_file, options):
+    """
+    Convert a file (or export it, if the options have a sidecar_format), any error making it
+    fail instead of being raised.
+    """
+    stats = Stats() if options.pop('with_stats', False) else NULL_STATS
+    try:
+        if 'sidecar_format' in options:
+            return export_file(input_file, stats=stats, **options)
+        return convert_file(input_file, stats=stats, **options)
+    except Exception as err:  # one bad file must not stop the others
+        _LOGGER.debug("Failed to convert %s", input_file, exc_info=True)
+        return FileResult(input_file, FAILED, stats=stats.as_dict(), error=str(err))
+
+
+def _prefetch(input_file):
+    """Ask the kernel to start reading the given file, so that its I/O overlaps other work."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(input_file, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def convert_many(paths, jobs=None, with_stats=False, **options):
+    """
+    Convert the given files with a pool of jobs worker processes (the cpu count by default,
+    within this process if 1). The options are those of convert_file, or of export_file if
+    they have a sidecar_format. Return the FileResult
+    of every file, in the same order; a file that raised has the FAILED status.
+    """
+    paths = list(paths)
+    for path in paths:
+        _prefetch(path)
+    options['with_stats'] = with_stats
+    if jobs == 1:
+        return [_convert_job(path, dict(options)) for path in paths]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_convert_job, paths, [dict(options) for _ in paths]))
+
+
+async def convert_many_async(paths, jobs=None, executor=None, with_stats=False, **options):
+    """
+    Same as convert_many, without blocking the event loop. The files are converted with the
+    given executor, or a pool of jobs worker processes.
+    """
+    import asyncio
+    paths = list(paths)
+    loop = asyncio.get_running_loop()
+    # the hint is only a syscall per file, but it is not worth blocking the loop for many
+    await loop.run_in_executor(None, lambda: [_prefetch(path) for path in paths])
+    options['with_stats'] = with_stats
+    own_executor = executor is None
+    if own_executor:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        return await asyncio.gather(*(
+            loop.run_in_executor(executor, _convert_job, path, dict(options))
+            for path in paths))
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
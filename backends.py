@@ -0,0 +1,221 @@
+"""
+For reading, searching and writing highlights of a pdf file with either PyMuPDF or pdfrw.
+"""
+import os
+import logging
+import fitz
+from pdfrw import PdfReader, PdfWriter, PdfArray, PdfString
+
+from helper import (
+    COMPACT_PRECISION,
+    RectBatch,
+    SharedProperties,
+    create_highlight,
+    add_annots,
+    rounding_savings,
+)
+from pdf_text_search import PDFTextSearch
+from stats import NULL_STATS
+from fsutil import write_aside
+
+_LOGGER = logging.getLogger(__name__)
+
+# garbage collect and merge duplicated objects, rebuild the xref and compress the streams
+NORMALISE_OPTIONS = dict(garbage=3, deflate=True)
+
+
+def normalise_pdf(pdf_path):
+    """
+    Fix up the internal structure of a converted pdf in process, which used to be done by
+    re-saving it with foxitreader. The highlights without an appearance stream get one
+    generated, then the file is rewritten with its unused objects removed, a rebuilt xref and
+    compressed streams.
+    """
+    doc = fitz.open(pdf_path)
+    for page in doc:
+        annot = page.firstAnnot
+        while annot:
+            if (annot.type[1] == 'Highlight' and
+                    '/AP' not in doc.xrefObject(annot.xref, compressed=True)):
+                annot.update()
+            annot = annot.next
+    write_aside(pdf_path, lambda tmp_path: doc.save(tmp_path, **NORMALISE_OPTIONS))
+    doc.close()
+
+
+class FitzBackend:
+    """
+    Represent a pdf that is read, searched and written with one PyMuPDF document, so that the
+    file is only parsed once.
+    """
+    name = 'fitz'
+
+    def __init__(self, input_file, stats=NULL_STATS, page_cache=None, compact=False,
+                 precision=COMPACT_PRECISION):
+        self.input_file = input_file
+        self.searcher = PDFTextSearch(input_file, stats=stats, page_cache=page_cache)
+        self.doc = self.searcher.doc
+        self.precision = precision if compact else None
+        self.colors = SharedProperties(self._new_object) if compact else None
+        self.authors = SharedProperties(self._new_object) if compact else None
+        self.rounding_saved = 0
+
+    @property
+    def page_count(self):
+        """Return the number of pages."""
+        return self.doc.pageCount
+
+    @property
+    def bytes_saved(self):
+        """Return the bytes saved by the compact output (an estimate), 0 if not compact."""
+        if self.precision is None:
+            return 0
+        return self.rounding_saved + self.colors.bytes_saved + self.authors.bytes_saved
+
+    def _new_object(self, value):
+        """Return the xref of a new indirect object of the given color or author."""
+        xref = self.doc.get_new_xref()
+        if isinstance(value, str):
+            self.doc.updateObject(xref, fitz.getPDFstr(value))
+        else:
+            self.doc.updateObject(xref, '[{}]'.format(' '.join('{:g}'.format(channel)
+                                                               for channel in value)))
+        return xref
+
+    def add_highlights(self, page_num, highlights):
+        """
+        Add highlights of the given [(quadpoints (in pdf coordinates), color, author,
+        contents)] to the page at once.
+        """
+        page = self.doc[page_num]
+        page_height = self.searcher.page_height(page_num)
+        for points, color, author, contents in highlights:
+            if self.precision is not None:
+                # MuPDF computes the rect from the quadpoints
+                self.rounding_saved += rounding_savings(points, self.precision, with_rect=False)
+                points = RectBatch(points).array.round(self.precision)
+            rects = PDFTextSearch.invert_coordinates(points, page_height).to_fitz()
+            annot = page.addHighlightAnnot(rects)
+            annot.setFlags(fitz.PDF_ANNOT_IS_PRINT)  # same as the pdfrw highlight
+            annot.setColors({'stroke': color})
+            annot.setInfo({'title': author or '', 'content': contents or ''})
+            annot.update()
+            if self.precision is not None:
+                # once the appearance is generated, the properties are not written again
+                self.doc.xref_set_key(annot.xref, 'C', '{} 0 R'.format(self.colors.get(color)))
+                if author:
+                    self.doc.xref_set_key(annot.xref, 'T',
+                                          '{} 0 R'.format(self.authors.get(author)))
+
+    def save(self, output, incremental=False, normalise=True):
+        """
+        Write the document to output, which can be the input file itself. If incremental, only
+        the new objects are appended to the input file as a new revision. Otherwise, if
+        normalise, the file is also cleaned up while being written (see normalise_pdf).
+        """
+        same_file = os.path.abspath(output) == os.path.abspath(self.input_file)
+        if incremental and same_file and self.doc.can_save_incrementally():
+            self.doc.save(output, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+            return
+        if incremental:
+            _LOGGER.warning("Cannot save '%s' incrementally, rewriting the entire file.", output)
+        options = NORMALISE_OPTIONS if normalise else {}
+        # the opened file cannot be overwritten directly, and the output may share its inode
+        # with a backup, write aside then replace it
+        write_aside(output, lambda tmp_output: self.doc.save(tmp_output, **options))
+
+    def close(self):
+        """Release the document."""
+        self.doc.close()
+
+
+class PdfrwBackend:
+    """
+    Represent a pdf that is written with pdfrw, and searched with PyMuPDF. The file is parsed
+    by both libraries.
+    """
+    name = 'pdfrw'
+
+    def __init__(self, input_file, stats=NULL_STATS, page_cache=None, compact=False,
+                 precision=COMPACT_PRECISION):
+        self.input_file = input_file
+        self.searcher = PDFTextSearch(input_file, stats=stats, page_cache=page_cache)
+        self.trailer = PdfReader(input_file)
+        self.precision = precision if compact else None
+        self.colors = SharedProperties(self._new_color) if compact else None
+        self.authors = SharedProperties(self._new_author) if compact else None
+        self.rounding_saved = 0
+
+    @property
+    def page_count(self):
+        """Return the number of pages."""
+        return len(self.trailer.pages)
+
+    @property
+    def bytes_saved(self):
+        """Return the bytes saved by the compact output (an estimate), 0 if not compact."""
+        if self.precision is None:
+            return 0
+        return self.rounding_saved + self.colors.bytes_saved + self.authors.bytes_saved
+
+    @staticmethod
+    def _new_color(color):
+        """Return a new indirect array of the given color."""
+        shared = PdfArray(color)
+        shared.indirect = True
+        return shared
+
+    @staticmethod
+    def _new_author(author):
+        """Return a new indirect string of the given author."""
+        shared = PdfString.encode(author)
+        shared.indirect = True
+        return shared
+
+    def add_highlights(self, page_num, highlights):
+        """
+        Add highlights of the given [(quadpoints (in pdf coordinates), color, author,
+        contents)] to the page at once.
+        """
+        annots = []
+        for points, color, author, contents in highlights:
+            if self.precision is not None:
+                self.rounding_saved += rounding_savings(points, self.precision)
+                color = self.colors.get(color)
+                author = self.authors.get(author) if author else author
+            annots.append(create_highlight(points,
+                                           author=author,
+                                           contents=contents,
+                                           color=color,
+                                           precision=self.precision))
+        add_annots(self.trailer.pages[page_num], annots)
+
+    def save(self, output, incremental=False, normalise=True):
+        """
+        Write the document to output. pdfrw can only rewrite the entire file. If normalise, the
+        written file is cleaned up afterward (see normalise_pdf).
+        """
+        write_aside(output, lambda tmp_output: PdfWriter(tmp_output, trailer=self.trailer).write())
+        if normalise:
+            normalise_pdf(output)
+
+    def close(self):
+        """Release the document."""
+        self.searcher.doc.close()
+
+
+BACKENDS = {
+    FitzBackend.name: FitzBackend,
+    PdfrwBackend.name: PdfrwBackend,
+}
+
+
+def open_backend(input_file, backend=FitzBackend.name, stats=NULL_STATS, page_cache=None,
+                 compact=False, precision=COMPACT_PRECISION):
+    """
+    Open the given pdf with the named backend, reusing the given page cache if any. If
+    compact, the highlights share their color and author objects, and their coordinates are
+    rounded to precision decimals.
+    """
+    return BACKENDS[backend](input_file, stats=stats, page_cache=page_cache, compact=compact,
+                             precision=precision)
@@ -0,0 +1,5 @@
+"""
+Benchmarks of the conversion, on synthetic libraries of Boox annotated pdf.
+
+Run from the repository root with ``python -m benchmarks.run``.
+"""
@@ -0,0 +1,76 @@
+"""
+Check that the commands which only touch the filesystem start quickly: they must not import
+the pdf stack, and the time spent importing modules must stay within a budget.
+
+    python -m benchmarks.import_budget --budget-ms 120
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# modules only needed by a conversion
+HEAVY_MODULES = ('fitz', 'pdfrw', 'numpy', 'sqlite3')
+COMMANDS = (
+    ['-c'],
+    ['-r'],
+    ['-r', '-i'],
+    ['-c', '--clean-entire-dir'],
+)
+
+
+def profile_imports(cli_args):
+    """
+    Run the cli with the given arguments, return the total time spent importing in ms, and the
+    imported top level modules.
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', 'main.py'] + cli_args,
+                             cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    total_us = 0
+    modules = set()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip().split('.')[0])
+        # nested imports are indented, their time is within the cumulative of their parent
+        if not name[1:].startswith(' '):
+            total_us += int(cumulative)
+    return total_us / 1000, modules
+
+
+def main():
+    """Entry point when this file is run."""
+    parser = argparse.ArgumentParser(
+        description="Check the import time of the non converting commands.")
+    parser.add_argument("--budget-ms", type=float, default=120,
+                        help="Maximum import time of every command. (default: 120)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of runs of every command, the best is reported. "
+                             "(default: 3)")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='boox-import-')
+    failed = False
+    try:
+        for command in COMMANDS:
+            runs = [profile_imports(command + [tmp_dir]) for _ in range(args.repeat)]
+            import_ms = min(ms for ms, _ in runs)
+            # the imported modules are the same on every run
+            heavy = sorted(set(HEAVY_MODULES) & runs[0][1])
+            ok = import_ms <= args.budget_ms and not heavy
+            failed |= not ok
+            print('{:<28} {:>8.1f} ms  {}{}'.format(
+                ' '.join(command), import_ms, 'ok' if ok else 'FAILED',
+                ' (imports {})'.format(', '.join(heavy)) if heavy else ''))
+    finally:
+        shutil.rmtree(tmp_dir)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Time the stages of the conversion on synthetic books of different sizes, and write the results
+as json so that runs can be compared.
+
+    python -m benchmarks.run --pages 10,100 --columns 1,2 --output bench.json
+    python -m benchmarks.run --pages 10,100 --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import contextlib
+import fitz
+
+from boox_annot_reader import read_annotations
+from pdf_text_search import (
+    PDFTextSearch,
+    TextNotFoundException,
+    MultipleInstancesException,
+)
+from main import convert
+from benchmarks.synthetic import make_book
+
+
+class Timer:
+    """Accumulate the wall time and the number of calls of a stage."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+
+    @contextlib.contextmanager
+    def __call__(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.calls += 1
+
+
+def bench_book(pdf_path, backend):
+    """Time every stage on the given book. Return {stage: Timer}."""
+    timers = {stage: Timer() for stage in (
+        'read_annotations', 'get_quadpoints', 'fallback_get_quadpoints', 'merge_tokens',
+        'points_exist', 'convert')}
+    with timers['read_annotations']():
+        annotations = read_annotations(pdf_path)
+
+    searcher = PDFTextSearch(pdf_path)
+    for annot in annotations:
+        try:
+            with timers['get_quadpoints']():
+                points = searcher.get_quadpoints(annot.page, annot.text)
+            tokens = searcher.get_quadpoints(annot.page, annot.text, extract=False)
+            # built by get_quadpoints already, as in the conversion
+            layout = searcher.page_index(annot.page).layout()
+            with timers['merge_tokens']():
+                searcher.merge_tokens(tokens, layout)
+        except TextNotFoundException:
+            try:
+                with timers['fallback_get_quadpoints']():
+                    points = searcher.fallback_get_quadpoints(annot.page, annot.text)
+            except (TextNotFoundException, MultipleInstancesException):
+                continue
+        except MultipleInstancesException:
+            continue
+        with timers['points_exist']():
+            searcher.points_exist(annot.page, points)
+    searcher.doc.close()
+
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        with timers['convert']():
+            convert(pdf_path, backend=backend)
+    return timers
+
+
+def run(pages_list, columns_list, annotations_per_page, backend, repeat):
+    """Run the benchmark over all the sizes. Return the list of results."""
+    results = []
+    for pages in pages_list:
+        for columns in columns_list:
+            for run_num in range(repeat):
+                tmp_dir = tempfile.mkdtemp(prefix='boox-bench-')
+                try:
+                    pdf_path = make_book(tmp_dir, pages=pages, columns=columns,
+                                         annotations_per_page=annotations_per_page,
+                                         seed=run_num)
+                    timers = bench_book(pdf_path, backend)
+                finally:
+                    shutil.rmtree(tmp_dir)
+                for stage, timer in timers.items():
+                    results.append({
+                        'case': '{}p-{}c'.format(pages, columns),
+                        'pages': pages,
+                        'columns': columns,
+                        'run': run_num,
+                        'stage': stage,
+                        'calls': timer.calls,
+                        'seconds': timer.seconds,
+                    })
+    return results
+
+
+def summarise(results):
+    """Return {(case, stage): best seconds} over the repeated runs."""
+    best = {}
+    for result in results:
+        key = (result['case'], result['stage'])
+        best[key] = min(best.get(key, float('inf')), result['seconds'])
+    return best
+
+
+def print_results(results, baseline=None):
+    """Print the best time of every stage, with the ratio against a baseline if given."""
+    best = summarise(results)
+    base = summarise(baseline) if baseline else {}
+    print('{:<12} {:<24} {:>12} {:>10}'.format('case', 'stage', 'seconds', 'vs base'))
+    for (case, stage), seconds in best.items():
+        ratio = ''
+        if base.get((case, stage)):
+            ratio = '{:.2f}x'.format(seconds / base[(case, stage)])
+        print('{:<12} {:<24} {:>12.4f} {:>10}'.format(case, stage, seconds, ratio))
+
+
+def main():
+    """Entry point when this file is run."""
+    parser = argparse.ArgumentParser(description="Benchmark the boox highlight conversion.")
+    parser.add_argument("--pages", default='10,100',
+                        help="Comma separated page counts of the books. (default: 10,100)")
+    parser.add_argument("--columns", default='1,2',
+                        help="Comma separated column counts of the books. (default: 1,2)")
+    parser.add_argument("--annotations-per-page", type=int, default=2,
+                        help="Number of annotations on each page. (default: 2)")
+    parser.add_argument("--backend", default='fitz',
+                        help="Backend used by the end to end conversion. (default: fitz)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of runs of every case, the best is reported. (default: 3)")
+    parser.add_argument("--output", help="Write the results to this json file.")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="Compare the results against those of an earlier run.")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    results = run([int(p) for p in args.pages.split(',')],
+                  [int(c) for c in args.columns.split(',')],
+                  args.annotations_per_page, args.backend, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'meta': {
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'python': sys.version.split()[0],
+                    'platform': platform.platform(),
+                    'pymupdf': fitz.VersionBind,
+                    'backend': args.backend,
+                },
+                'results': results,
+            }, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
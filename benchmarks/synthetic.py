@@ -0,0 +1,96 @@
+"""
+For generating synthetic pdf files, together with their Boox annotation .txt file.
+"""
+import os
+import random
+import fitz
+
+from boox_annot_reader import annotation_path
+
+WORDS = ("the of and to in is that for it as was with be by on not he this are or his "
+         "from at which but have an they you were her she there been one all we their "
+         "system method result analysis function value between however approximately "
+         "structure different following important measurement distribution").split()
+
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+MARGIN = 56
+FONT_SIZE = 9
+LINE_HEIGHT = 12
+COLUMN_GAP = 18
+END_OF_ANNOT = '--------------------'
+PLACEHOLDER = b'\xef\xbf\xbe'
+
+
+def _line(rng, words_per_line):
+    """Return a random line of text."""
+    return ' '.join(rng.choice(WORDS) for _ in range(words_per_line))
+
+
+def make_book(directory, name='book', pages=10, columns=1, lines_per_column=50,
+              words_per_line=None, annotations_per_page=2, placeholder_ratio=0.2, seed=0):
+    """
+    Write a synthetic pdf with its Boox annotation file in directory. Every annotation
+    highlights one to four consecutive lines of a column; some of them have a word broken by
+    a placeholder, as Boox does for the tokens it cannot recognise. Return the pdf path.
+    """
+    rng = random.Random(seed)
+    column_width = (PAGE_WIDTH - 2 * MARGIN - (columns - 1) * COLUMN_GAP) / columns
+    if words_per_line is None:
+        words_per_line = max(3, int(column_width / 38))
+    lines_per_column = min(lines_per_column, (PAGE_HEIGHT - 2 * MARGIN) // LINE_HEIGHT)
+
+    doc = fitz.open()
+    entries = []
+    for page_num in range(pages):
+        page = doc.newPage(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        page_columns = []
+        for col in range(columns):
+            x = MARGIN + col * (column_width + COLUMN_GAP)
+            lines = [_line(rng, words_per_line) for _ in range(lines_per_column)]
+            for i, line in enumerate(lines):
+                page.insertText((x, MARGIN + (i + 1) * LINE_HEIGHT), line, fontsize=FONT_SIZE)
+            page_columns.append(lines)
+        for _ in range(annotations_per_page):
+            lines = rng.choice(page_columns)
+            start = rng.randrange(len(lines))
+            # start and end within a line, so that the text is not the entire lines
+            text_lines = lines[start:start + rng.randint(1, 4)]
+            first = text_lines[0].split(' ')
+            text_lines[0] = ' '.join(first[rng.randrange(len(first) // 2 + 1):])
+            entries.append((page_num, text_lines,
+                            rng.random() < placeholder_ratio,
+                            'note {}'.format(len(entries)) if rng.random() < 0.3 else ''))
+    pdf_path = os.path.join(directory, name + '.pdf')
+    doc.save(pdf_path)
+    doc.close()
+    write_annotations(annotation_path(pdf_path), entries, rng)
+    return pdf_path
+
+
+def write_annotations(annotation_file_name, entries, rng):
+    """Write the given (page, text lines, with placeholder, comment) in Boox format."""
+    os.makedirs(os.path.dirname(annotation_file_name), exist_ok=True)
+    with open(annotation_file_name, 'wb') as annot_file:
+        for page_num, text_lines, with_placeholder, comment in entries:
+            # page line is 1-based, followed by the comment
+            annot_file.write('Page {}  {}\n'.format(page_num + 1, comment).encode('utf-8'))
+            body = []
+            for line in text_lines:
+                line = line.encode('utf-8')
+                if with_placeholder:
+                    words = line.split(b' ')
+                    i = rng.randrange(len(words))
+                    if len(words[i]) > 3:
+                        words[i] = words[i][:2] + PLACEHOLDER + words[i][2:]
+                        with_placeholder = False
+                    line = b' '.join(words)
+                body.append(line)
+            annot_file.write(b'\r\n'.join(body) + b'\x00\n')
+            annot_file.write(END_OF_ANNOT.encode('utf-8') + b'\n')
+
+
+def make_library(directory, books=4, **kwargs):
+    """Write a library of synthetic books in directory. Return the pdf paths."""
+    return [make_book(directory, name='book{:03d}'.format(i), seed=i, **kwargs)
+            for i in range(books)]
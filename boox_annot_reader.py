@@ -5,14 +5,27 @@ import os
 import re
 import logging
 
-_LOGGER = logging.getLogger()
+from stats import NULL_STATS
+
+_LOGGER = logging.getLogger(__name__)
+
+PAGE_LINE = re.compile(r'(?:Page )([0-9]+)\s{1,2}(.*)?\n')
+END_OF_ANNOT = '--------------------'
+# this indicate some token that the program cannot recognise (as place holder)
+PLACEHOLDERS = ("\xef\xbf\xbe", "\ufffe")
+
+class AnnotationFormatException(Exception):
+    """Exception for a boox annotation file that cannot be parsed."""
+    pass
 
 class Annot:
     """Class that represents an annotation."""
-    def __init__(self):
-        self.page = None
-        self.text = ""
-        self.comment = None
+    __slots__ = ('page', 'text', 'comment')
+
+    def __init__(self, page=None, text="", comment=None):
+        self.page = page
+        self.text = text
+        self.comment = comment
 
     def __repr__(self):
         return "<{}: page: {}, text: {}, comment: {}>".format(
@@ -20,66 +33,143 @@ class Annot:
             self.page, self.text,
             self.comment)
 
-def read_annotations(pdf_path):
-    """Read annotations from folder that hold the .txt file, then return the text."""
+def annotation_path(pdf_path):
+    """Return the path of the .txt file that holds the annotations of the given pdf."""
     path_name = os.path.splitext(pdf_path)[0]
     base_name_with_ext = os.path.basename(pdf_path)
     base_name = os.path.splitext(base_name_with_ext)[0]
-    annotation_file_name = os.path.join(path_name, base_name + '-annotation.txt')
+    return os.path.join(path_name, base_name + '-annotation.txt')
+
+def annotation_pdf_path(annotation_file_name):
+    """Return the path of the pdf that the given annotation .txt file belongs to."""
+    annot_dir = os.path.dirname(annotation_file_name)
+    return os.path.join(os.path.dirname(annot_dir), os.path.basename(annot_dir) + '.pdf')
+
+def parse_annotations(lines):
+    """
+    Parse the lines of a boox annotation file, and yield each annotation as soon as its end
+    of annotation line is read. Only the lines of the current annotation are kept in memory.
+    """
+    begining_anno = True
+    ended = False
+    page = None
+    text_parts = []
+    comment_parts = []
+    for line in lines:
+        ##############################
+        ##  REPLACE INVALID TOKENS  ##
+        ##############################
+        for placeholder in PLACEHOLDERS:
+            if placeholder in line:
+                # It likely to be a hyphen for word break. Replace it as '-'.
+                line = line.replace(placeholder, '-\n')
+        ###########################
+        if begining_anno:
+            ### Page line + Comment
+            begining_anno = False
+            match_obj = PAGE_LINE.match(line)
+
+            if not match_obj:
+                raise AnnotationFormatException("Error in parsing first line")
+
+            page = match_obj.group(1)
+            text_parts = []
+            comment_parts = [match_obj.group(2) or '']
+        elif '\x00' in line:
+            ### Last line before End of annotation
+            ended = True
+            text_parts.append(line.replace('\x00', ''))
+        elif END_OF_ANNOT in line:
+            ### End of annotation
+            if not ended:
+                raise AnnotationFormatException("Did not detect \\x00 indicating end of line?")
+            begining_anno = True
+            ended = False
+            # fix ups the formatting of each components
+            # NOTE this -1 because in the program index starts at 0
+            # remove empty comment
+            yield Annot(page=int(page) - 1,
+                        text=''.join(text_parts).rstrip(),
+                        comment=''.join(comment_parts).rstrip() or None)
+        elif '\r\n' in line:
+            ### text (highlighted pdf text)
+            text_parts.append(line)
+        elif '\n' in  line:
+            ### Comment
+            comment_parts.append(line)
+        else:
+            raise AnnotationFormatException(
+                "ERROR: The boox annotations txt file contain unrecognisible line")
+
+def group_by_page(annotations):
+    """Yield (page, annotations) for every run of consecutive annotations on the same page."""
+    page = None
+    group = []
+    for annot in annotations:
+        if group and annot.page != page:
+            yield page, group
+            group = []
+        page = annot.page
+        group.append(annot)
+    if group:
+        yield page, group
+
+def iter_page_annotations(pdf_path, stats=NULL_STATS):
+    """
+    Read annotations from folder that hold the .txt file while streaming through it, and yield
+    them grouped by page. Yield nothing if the .txt file does not exists.
+    """
+    annotation_file_name = annotation_path(pdf_path)
+    if not os.path.isfile(annotation_file_name):
+        _LOGGER.debug("Expected annotation file does not exists.")
+        return
+    with open(annotation_file_name, 'r', newline='') as annot_file:
+        # the newline parameter stop python from translating \r\n to \n
+        page_groups = group_by_page(parse_annotations(annot_file))
+        while True:
+            # only the time spent in reading is accounted, not the time of the caller
+            with stats.timer('parse'):
+                group = next(page_groups, None)
+            if group is None:
+                return
+            stats.incr('annotations', len(group[1]))
+            yield group
+
+def read_annotations(pdf_path, stats=NULL_STATS):
+    """Read annotations from folder that hold the .txt file, then return the text."""
+    annotation_file_name = annotation_path(pdf_path)
     if not os.path.isfile(annotation_file_name):
         _LOGGER.debug("Expected annotation file does not exists.")
         return None
     with open(annotation_file_name, 'r', newline='') as annot_file:
         # the newline parameter stop python from translating \r\n to \n
-        begining_anno = True
-        ended = False
-        annotations = []
-        for line in annot_file.readlines():
-            ##############################
-            ##  REPLACE INVALID TOKENS  ##
-            ##############################
-            # this indicate some token that the program cannot recognise (as place holder)
-            if "\xef\xbf\xbe" in line:
-                # It likely to be a hyphen for word break. Replace it as '-'.
-                line = line.replace("\xef\xbf\xbe", '-\n')
-            ###########################
-            if begining_anno:
-                ### Page line + Comment
-                annotations.append(Annot())
-
-                begining_anno = False
-                match_obj = re.match(r'(?:Page )([0-9]+)\s{1,2}(.*)?\n', line)
-
-                if not match_obj:
-                    raise Exception("Error in parsing first line")
-
-                annotations[-1].page = match_obj.group(1)
-                annotations[-1].comment = match_obj.group(2)
-            elif '\x00' in line:
-                ### Last line before End of annotation
-                ended = True
-                line = line.replace('\x00', '')
-                annotations[-1].text += line
-            elif '--------------------' in line:
-                ### End of annotation
-                if not ended:
-                    raise Exception("Did not detect \\x00 indicating end of line?")
-                begining_anno = True
-                ended = False
-                # fix ups the formatting of each components
-                # NOTE this -1 because in the program index starts at 0
-                annotations[-1].page = int(annotations[-1].page) - 1
-                annotations[-1].text = annotations[-1].text.rstrip()
-                annotations[-1].comment = annotations[-1].comment.rstrip()
-                if not annotations[-1].comment:
-                    # remove empty comment
-                    annotations[-1].comment = None
-            elif '\r\n' in line:
-                ### text (highlighted pdf text)
-                annotations[-1].text += line
-            elif '\n' in  line:
-                ### Comment
-                annotations[-1].comment += line
-            else:
-                raise Exception("ERROR: The boox annotations txt file contain unrecognisible line")
+        with stats.timer('parse'):
+            annotations = list(parse_annotations(annot_file))
+    stats.incr('annotations', len(annotations))
     return annotations
+
+def read_new_annotations(annotation_file_name, offset=0):
+    """
+    Read the complete annotations that come after the given byte offset of the .txt file, which
+    must be the end of a previous annotation. Return the annotations, and the byte offset right
+    after the last complete one (an annotation that is still being written is left out).
+    """
+    position = offset
+    end = offset
+    annotations = []
+    with open(annotation_file_name, 'rb') as annot_file:
+        annot_file.seek(offset)
+        def lines():
+            """Yield the decoded complete lines, while keeping track of the offset."""
+            nonlocal position
+            for line in annot_file:
+                if not line.endswith(b'\n'):
+                    # partially written line
+                    return
+                position += len(line)
+                yield line.decode('utf-8')
+        for annot in parse_annotations(lines()):
+            annotations.append(annot)
+            # the end of annotation line is the last line that has been read
+            end = position
+    return annotations, end
@@ -0,0 +1,55 @@
+"""
+Thin client of the conversion server (see server.py), which takes the same arguments as
+main.py. If no server is listening, the conversion is run within this process instead.
+
+    python main.py --server &
+    python client.py -i book.pdf
+"""
+import os
+import sys
+import json
+import socket
+import getpass
+import tempfile
+
+DEFAULT_SOCKET = os.environ.get('BOOX_HLCONVERT_SOCKET') or os.path.join(
+    tempfile.gettempdir(), 'boox-hlconvert-{}.sock'.format(getpass.getuser()))
+
+
+def socket_path(argv):
+    """Return the socket given by --socket in the arguments, or the default one."""
+    for i, arg in enumerate(argv):
+        if arg == '--socket' and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith('--socket='):
+            return arg[len('--socket='):]
+    return DEFAULT_SOCKET
+
+
+def send_job(path, argv, cwd):
+    """Send the given arguments to the server and wait for it. Return its status and output."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        with conn.makefile('rwb') as stream:
+            stream.write(json.dumps({'argv': argv, 'cwd': cwd}).encode('utf-8') + b'\n')
+            stream.flush()
+            response = json.loads(stream.readline().decode('utf-8'))
+    return response['status'], response['output']
+
+
+def main():
+    """Entry point when this file is run."""
+    argv = sys.argv[1:]
+    try:
+        status, output = send_job(socket_path(argv), argv, os.getcwd())
+    except (FileNotFoundError, ConnectionRefusedError):
+        # no server is running
+        import main as cli
+        cli.main()
+        return
+    sys.stdout.write(output)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
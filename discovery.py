@@ -0,0 +1,133 @@
+"""
+For finding the work items of a library: every pdf (at any depth) with its annotation file,
+bak file and sidecar. Each directory is listed once with os.scandir, and the annotation
+folders are matched to their pdf while listing, so that a library of many pdf with few
+annotation folders is discovered without checking every pdf afterwards.
+"""
+import os
+import re
+import fnmatch
+
+PDF_SUFFIX = '.pdf'
+BAK_SUFFIX = '.bak'
+ANNOTATION_SUFFIX = '-annotation.txt'
+# same as sidecar.SIDECAR_FORMATS, without importing it
+SIDECAR_SUFFIXES = ('.highlights.json', '.xfdf')
+
+
+class LibraryItem:
+    """
+    Represent a pdf of a library, and the files that belong to it (None when missing): the
+    .txt file of its annotations, the folder that holds it, its bak file and its sidecar. The
+    pdf itself may be missing (exists is False) when only its bak file is left.
+    """
+    __slots__ = ('pdf_path', 'exists', 'annotation_file', 'annotation_dir', 'backup_file',
+                 'sidecar_file')
+
+    def __init__(self, pdf_path, exists=True, annotation_file=None, annotation_dir=None,
+                 backup_file=None, sidecar_file=None):
+        self.pdf_path = pdf_path
+        self.exists = exists
+        self.annotation_file = annotation_file
+        self.annotation_dir = annotation_dir
+        self.backup_file = backup_file
+        self.sidecar_file = sidecar_file
+
+    def convertible(self, sidecar=False):
+        """
+        Determine if the pdf can be converted: it exists, and so does its annotation file (or
+        its sidecar, if the sidecar is what gets applied).
+        """
+        if not self.exists:
+            return False
+        return (self.sidecar_file if sidecar else self.annotation_file) is not None
+
+
+def _compile(patterns):
+    """Return a regex that matches any of the given globs, or None if there is none."""
+    if not patterns:
+        return None
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns))
+
+
+class LibraryScanner:
+    """
+    Represent the discovery of the items of a library. The include and exclude globs are
+    matched against the path of each pdf relative to the root (with '/' as separator); an
+    excluded directory is not descended into. Hidden directories (such as the versions kept
+    by file synchronisers) are skipped, and so are the symlinks to directories.
+    """
+
+    def __init__(self, root, include=(), exclude=(), recursive=True):
+        self.root = root
+        self.include = _compile(include)
+        self.exclude = _compile(exclude)
+        self.recursive = recursive
+
+    def _selected(self, rel_path):
+        """Determine if the pdf of the given relative path passes the globs."""
+        if self.exclude is not None and self.exclude.match(rel_path):
+            return False
+        return self.include is None or self.include.match(rel_path) is not None
+
+    def scan(self):
+        """Yield the items of the library, directory by directory, each sorted by name."""
+        pending = ['']
+        while pending:
+            rel_dir = pending.pop()
+            subdirs = []
+            yield from self._scan_dir(rel_dir, subdirs)
+            if self.recursive:
+                # popped from the end, hence reversed to descend in name order
+                pending.extend(reversed(subdirs))
+
+    def _scan_dir(self, rel_dir, subdirs):
+        """
+        Yield the items of one directory, and append its subdirectories to descend into to
+        subdirs.
+        """
+        directory = os.path.join(self.root, rel_dir)
+        pdf_names, bak_names, other_files, dir_names = set(), set(), set(), set()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dir_names.add(entry.name)
+                    elif entry.name.endswith(PDF_SUFFIX):
+                        pdf_names.add(entry.name)
+                    elif entry.name.endswith(PDF_SUFFIX + BAK_SUFFIX):
+                        bak_names.add(entry.name[:-len(BAK_SUFFIX)])
+                    else:
+                        other_files.add(entry.name)
+        except OSError:  # vanished, or not readable
+            return
+        for name in sorted(dir_names):
+            if name.startswith('.'):
+                continue
+            rel_path = os.path.join(rel_dir, name).replace(os.sep, '/')
+            if self.exclude is not None and self.exclude.match(rel_path):
+                continue
+            subdirs.append(os.path.join(rel_dir, name))
+        for name in sorted(pdf_names | bak_names):
+            if not self._selected(os.path.join(rel_dir, name).replace(os.sep, '/')):
+                continue
+            stem = os.path.splitext(name)[0]
+            item = LibraryItem(os.path.join(directory, name), exists=name in pdf_names)
+            if name in bak_names:
+                item.backup_file = item.pdf_path + BAK_SUFFIX
+            if stem in dir_names:
+                item.annotation_dir = os.path.join(directory, stem)
+                annotation_file = os.path.join(item.annotation_dir, stem + ANNOTATION_SUFFIX)
+                # the only check that is not answered by the listing, once per folder
+                if os.path.isfile(annotation_file):
+                    item.annotation_file = annotation_file
+            for suffix in SIDECAR_SUFFIXES:
+                if stem + suffix in other_files:
+                    item.sidecar_file = os.path.join(directory, stem + suffix)
+                    break
+            yield item
+
+
+def discover(root, include=(), exclude=(), recursive=True):
+    """Return the items of the library at root (see LibraryScanner)."""
+    return list(LibraryScanner(root, include, exclude, recursive).scan())
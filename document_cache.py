@@ -0,0 +1,78 @@
+"""
+For keeping the state of the pages of recently converted documents, within a long running
+process.
+"""
+import os
+from collections import OrderedDict
+
+# rough memory used by every character of a page text index (its char, box, line and n-grams)
+INDEX_BYTES_PER_CHAR = 256
+
+
+class PageCache:
+    """
+    Represent the state of the pages of a document that does not depend on its annotations,
+    hence still holds once highlights are added to it: the text indexes and the page heights.
+    """
+    __slots__ = ('page_indexes', 'page_heights')
+
+    def __init__(self):
+        self.page_indexes = {}
+        self.page_heights = {}
+
+    def nbytes(self):
+        """Return the estimated memory used by the cached pages."""
+        return INDEX_BYTES_PER_CHAR * sum(len(index.text) for index in self.page_indexes.values())
+
+
+def file_identity(path):
+    """Return what identifies the content of the given file, without reading it."""
+    stat = os.stat(path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class DocumentCache:
+    """
+    Represent the page caches of the recently converted documents, keyed by file identity so
+    that a modified file is never matched against stale pages. The least recently used ones
+    are evicted once their estimated size exceeds max_bytes. A document can be known under
+    several identities (e.g. before and after its highlights are written), which share the
+    same page cache.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, path):
+        """Return the page cache of the given file, which is empty if it was not known."""
+        key = file_identity(path)
+        page_cache = self._entries.get(key)
+        if page_cache is None:
+            self.misses += 1
+            page_cache = self._entries[key] = PageCache()
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return page_cache
+
+    def alias(self, path, page_cache):
+        """Register the given page cache under the identity of the given file as well."""
+        key = file_identity(path)
+        self._entries[key] = page_cache
+        self._entries.move_to_end(key)
+
+    def nbytes(self):
+        """Return the estimated memory used by all the page caches."""
+        unique = {id(page_cache): page_cache for page_cache in self._entries.values()}
+        return sum(page_cache.nbytes() for page_cache in unique.values())
+
+    def trim(self):
+        """Evict the least recently used identities until the cache fits within max_bytes."""
+        while self._entries and self.nbytes() > self.max_bytes:
+            self._entries.popitem(last=False)
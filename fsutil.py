@@ -0,0 +1,178 @@
+"""
+For copying and replacing files without copying their data whenever possible.
+"""
+import os
+import re
+import mmap
+import errno
+import shutil
+import logging
+import tempfile
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+_LOGGER = logging.getLogger(__name__)
+
+# ioctl of linux to share the blocks of a file with another (btrfs, xfs, ...)
+FICLONE = 0x40049409
+# the objects of an uncompressed revision, and the author (/T) of an annotation: a literal
+# string or a reference to one
+PDF_OBJECT = re.compile(rb'(\d+)\s+0\s+obj\b(.*?)endobj', re.S)
+PDF_AUTHOR = re.compile(rb'/T\s*(\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>|(\d+)\s+0\s+R)')
+
+
+def write_aside(path, write):
+    """
+    Call write with a temporary path next to path, then replace path with the written file.
+    The file at path is never modified in place, so its other links (e.g. a backup) are kept.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix='.', dir=directory)
+    os.close(fd)
+    try:
+        # mkstemp creates the file only readable by the user
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o666 & ~_umask())
+        write(tmp_path)
+        os.replace(tmp_path, path)
+        if os.path.exists(tmp_path):
+            # a rename over another link of the same file does nothing
+            os.remove(tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _umask():
+    """Return the umask of the process."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def _reflink(src, dst):
+    """Make dst a reflink of src, raise OSError if the filesystem does not support it."""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflink is not supported')
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def _hardlink(src, dst):
+    """Make dst another link of src."""
+    os.remove(dst)
+    os.link(src, dst)
+
+
+def clone_file(src, dst, link=True):
+    """
+    Make dst a copy of src without copying its data when possible. A reflink shares the blocks
+    of src until either file is modified. Otherwise if link, dst becomes a hardlink of src,
+    which is only safe as long as neither of them is modified in place. Otherwise the data is
+    copied. dst is replaced atomically. Return the method used.
+    """
+    methods = [('reflink', _reflink)]
+    if link:
+        methods.append(('hardlink', _hardlink))
+    methods.append(('copy', shutil.copyfile))
+    for name, method in methods:
+        try:
+            write_aside(dst, lambda tmp_path: method(src, tmp_path))
+        except OSError as e:
+            if name == 'copy':
+                raise
+            _LOGGER.debug("Cannot %s '%s': %s", name, src, e)
+            continue
+        return name
+
+
+def unshare(path):
+    """
+    Make sure that the given file does not share its inode with another link (e.g. a hardlink
+    backup), so that it can be modified in place.
+    """
+    if os.stat(path).st_nlink > 1:
+        clone_file(path, path, link=False)
+
+
+def backup(inpfn, link=True):
+    """
+    Create a bak file for the given input file. The data is not copied if the filesystem
+    supports reflinks, otherwise if link the bak is a hardlink of the input: the converted file
+    is always written aside then renamed over the input, so the original inode is kept as the
+    bak. An input that is not going to be replaced must not be linked.
+    """
+    backup_file = '{}.bak'.format(inpfn)
+    if os.path.isfile(backup_file):
+        _LOGGER.debug('Found backup pdf. Using the bak as input instead.')
+        method = clone_file(backup_file, inpfn, link=link)
+    else:
+        method = clone_file(inpfn, backup_file, link=link)
+    _LOGGER.debug("Backup of '%s' made with %s", inpfn, method)
+
+
+def _pdf_strings(text):
+    """Return the ways a pdf writer may encode the given text as a string."""
+    literal = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    hex_utf16 = (b'\xfe\xff' + text.encode('utf-16-be')).hex()
+    strings = {'<{}>'.format(hex_utf16.upper()).encode(), '<{}>'.format(hex_utf16).encode()}
+    try:
+        strings.add('({})'.format(literal).encode('latin-1'))
+    except UnicodeEncodeError:
+        pass
+    return strings
+
+
+def revision_authors(revision):
+    """
+    Return the author of every highlight added by the given revision (the bytes of an
+    incremental update), as written in the file. It is None for a highlight without one.
+    """
+    objects = {int(number): body for number, body in PDF_OBJECT.findall(revision)}
+    authors = []
+    for body in objects.values():
+        if b'/Highlight' not in body:
+            continue
+        match = PDF_AUTHOR.search(body)
+        if match is None:
+            authors.append(None)
+        elif match.group(2):
+            # shared author of a compact output, written along
+            authors.append(objects.get(int(match.group(2)), b'').strip() or None)
+        else:
+            authors.append(match.group(1))
+    return authors
+
+
+def truncate_last_revision(pdf_path, author):
+    """
+    Undo the last incremental update of a pdf, by truncating the file right after the %%EOF
+    marker of its previous revision. Only an update that added highlights, all of the given
+    author, is considered as written by this converter. Return False if there is no previous
+    revision, or if the last one is not ours (e.g. highlights made with another pdf viewer).
+    """
+    if os.path.getsize(pdf_path) == 0:
+        return False
+    # read only, as most pdf have nothing to undo
+    with open(pdf_path, 'rb') as pdf_file:
+        with mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            last_eof = content.rfind(b'%%EOF')
+            prev_eof = content.rfind(b'%%EOF', 0, last_eof) if last_eof > 0 else -1
+            if prev_eof < 0:
+                return False
+            authors = revision_authors(content[prev_eof:last_eof])
+            if not authors or not set(authors) <= _pdf_strings(author):
+                return False
+            end = prev_eof + len(b'%%EOF')
+            # keep the end of line that follows the marker
+            if content[end:end+1] == b'\r':
+                end += 1
+            if content[end:end+1] == b'\n':
+                end += 1
+    os.truncate(pdf_path, end)
+    return True
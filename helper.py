@@ -1,9 +1,133 @@
 import fitz
-from pdfrw import PdfDict, PdfArray, PdfName
+import numpy as np
+from pdfrw import PdfDict, PdfArray, PdfName, PdfString
 
+# order of the rect coordinates in the quadpoints of one line, as defined by pdf
+QUAD_ORDER = [0, 3, 2, 3, 0, 1, 2, 1]
+# decimals kept of the coordinates of a compact output, far below what can be seen
+COMPACT_PRECISION = 2
+# bytes taken by a reference ('1234 0 R'), and by the wrapping and xref entry of an indirect
+# object ('1234 0 obj ... endobj'), in a file of a few thousands objects
+REFERENCE_SIZE = 8
+INDIRECT_OVERHEAD = 40
 
-def create_highlight(points, color=(1, 0.92, 0.23), author=None, contents=None):
-    """Given Quad points, create a highligh object in standard pdf format."""
+
+class RectBatch:
+    """
+    Represent a batch of rects (x0, y0, x1, y1) as a (n, 4) float array, so that the geometry
+    of all of them is computed at once. It can be built from fitz rects, tuples or an array,
+    and iterates as tuples.
+    """
+    __slots__ = ('array',)
+
+    def __init__(self, rects=()):
+        if isinstance(rects, RectBatch):
+            rects = rects.array
+        elif not isinstance(rects, np.ndarray):
+            rects = [tuple(r) for r in rects]
+        self.array = np.asarray(rects, dtype=float).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        return iter([tuple(r) for r in self.array.tolist()])
+
+    def __getitem__(self, idx):
+        return tuple(self.array[idx].tolist())
+
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__, self.array.tolist())
+
+    def to_fitz(self):
+        """Return the rects as a list of fitz rects."""
+        return [fitz.Rect(r) for r in self.array.tolist()]
+
+    def quadpoints(self):
+        """Return the quadpoints (8 coordinates) of every rect, as a list of lists."""
+        return self.array[:, QUAD_ORDER].tolist()
+
+
+class SharedProperties:
+    """
+    Represent the properties (colors, authors) that the highlights of a compact output refer
+    to as shared indirect objects, instead of each holding its own copy. The shared object of
+    every distinct value is created once by make(value). The bytes that the references save
+    over inline copies are counted in bytes_saved.
+    """
+    __slots__ = ('make', 'objects', 'bytes_saved')
+
+    def __init__(self, make):
+        self.make = make
+        self.objects = {}
+        self.bytes_saved = 0
+
+    def get(self, value):
+        """Return the shared object of the given value (a color or an author)."""
+        key = tuple(value) if isinstance(value, (list, tuple)) else value
+        if key not in self.objects:
+            self.objects[key] = self.make(value)
+            self.bytes_saved -= inline_size(value) + INDIRECT_OVERHEAD
+        self.bytes_saved += inline_size(value) - REFERENCE_SIZE
+        return self.objects[key]
+
+
+def pdf_real(value):
+    """Return the given number as MuPDF writes it: the shortest float, without leading 0."""
+    text = np.format_float_positional(np.float32(value), trim='-')
+    return text.replace('0.', '.', 1) if text.lstrip('-').startswith('0.') else text
+
+
+def inline_size(value):
+    """Return the bytes that a number, a string or an array of numbers takes in a pdf object."""
+    if isinstance(value, str):
+        return len(PdfString.encode(value))
+    if isinstance(value, (list, tuple)):
+        return len('[{}]'.format(' '.join(pdf_real(item) for item in value)))
+    return len(pdf_real(value))
+
+
+def highlight_geometry(points, precision=None):
+    """
+    Return the quadpoints (as one flat list) and the bounding rect of a highlight of the
+    given rects, rounded to precision decimals if given.
+    """
+    points = RectBatch(points).array
+    if precision is not None:
+        points = np.round(points, precision)
+    bot_left_x = bot_left_y = float('inf')
+    top_right_x = top_right_y = 0.0
+    if len(points):
+        xs = points[:, [0, 2]]
+        ys = points[:, [1, 3]]
+        bot_left_x = min(bot_left_x, float(xs.min()))
+        bot_left_y = min(bot_left_y, float(ys.min()))
+        top_right_x = max(top_right_x, float(xs.max()))
+        top_right_y = max(top_right_y, float(ys.max()))
+
+    # this quadpoints specified PDF definition of rect box
+    quad_pts = points[:, QUAD_ORDER].ravel().tolist()
+    return quad_pts, [bot_left_x, bot_left_y, top_right_x, top_right_y]
+
+
+def rounding_savings(points, precision, with_rect=True):
+    """
+    Return the bytes saved by rounding the geometry of a highlight (its quadpoints, and its
+    bounding rect unless computed by the pdf library) to precision decimals.
+    """
+    full = highlight_geometry(points)[:2 if with_rect else 1]
+    rounded = highlight_geometry(points, precision)[:2 if with_rect else 1]
+    return sum(len(pdf_real(coord)) for coords in full for coord in coords) - sum(
+        len(pdf_real(coord)) for coords in rounded for coord in coords)
+
+
+def create_highlight(points, color=(1, 0.92, 0.23), author=None, contents=None,
+                     precision=None):
+    """
+    Given Quad points, create a highligh object in standard pdf format. The color and author
+    can be shared objects (see SharedProperties), and the coordinates are rounded to precision
+    decimals if given.
+    """
     new_highlight = PdfDict()
     new_highlight.F = 4
     new_highlight.Type = PdfName('Annot')
@@ -18,37 +142,18 @@ def create_highlight(points, color=(1, 0.92, 0.23), author=None, contents=None):
     #############################################################
     ### Search for bounding coordinates
     #############################################################
-    bot_left_x = float('inf')
-    bot_left_y = float('inf')
-    top_right_x = 0.0
-    top_right_y = 0.0
-
-    quad_pts = []
-    for (x1, y1, x2, y2) in points:
-        # this quadpoints specified PDF definition of rect box
-        quad_pts.extend([x1, y2, x2, y2, x1, y1, x2, y1])
-        bot_left_x = min(bot_left_x, x1, x2)
-        bot_left_y = min(bot_left_y, y1, y2)
-        top_right_x = max(top_right_x, x1, x2)
-        top_right_y = max(top_right_y, y1, y2)
-
+    quad_pts, rect = highlight_geometry(points, precision)
     new_highlight.QuadPoints = PdfArray(quad_pts)
-    new_highlight.Rect = PdfArray([bot_left_x, bot_left_y,
-                                   top_right_x, top_right_y])
+    new_highlight.Rect = PdfArray(rect)
     return new_highlight
 
-def add_annot(pdfrw_page, annot):
-    """Add annotations to page, create an array if none exists yet"""
+def add_annots(pdfrw_page, annots):
+    """Add the given annotations to page at once, create an array if none exists yet"""
     if pdfrw_page.Annots is None:
         pdfrw_page.Annots = PdfArray()
-    pdfrw_page.Annots.append(annot)
+    pdfrw_page.Annots.extend(annots)
 
 def pdfrw_quadpoint_to_fitz_rect(pts):
     """Convert pdfrw quadpoints into fitz rect format (from one library to another)."""
-    origin = 0
-    rects = []
-    while origin < len(pts):
-        (x1, y1, x2, y2) = pts[origin+0], pts[origin+5], pts[origin+6], pts[origin+1]
-        rects.append(fitz.Rect(x1, y1, x2, y2))
-        origin += 8
-    return rects
+    quads = np.asarray([float(p) for p in pts], dtype=float).reshape(-1, 8)
+    return RectBatch(quads[:, [0, 5, 6, 1]])
@@ -4,89 +4,114 @@ import os
 import shutil
 import argparse
 import logging
+import io
+import contextlib
+from itertools import groupby
 from colorlog import ColoredFormatter
 
-from pdfrw import PdfReader, PdfWriter, PdfDict, PdfArray
-from helper import (
-    create_highlight,
-    add_annot,
+# the pdf stack (fitz, pdfrw, numpy) is only imported once a conversion happens, so that
+# cleaning up or restoring a directory starts quickly
+from api import (
+    AUTHOR,
+    convert_file,
+    export_file,
+    SKIPPED,
+    COMPACT_PRECISION,
+    PAGE_NOT_FOUND,
+    MULTIPLE_INSTANCES,
+    NOT_FOUND,
+    DUPLICATE,
 )
-from pdf_text_search import(
-    PDFTextSearch,
-    TextNotFoundException,
-    MultipleInstancesException
-)
-from boox_annot_reader import read_annotations
+from stats import NULL_STATS, Stats, StatsReport
+from fsutil import truncate_last_revision
+from discovery import discover
+from client import DEFAULT_SOCKET
 
 _LOGGER = logging.getLogger()
-AUTHOR = 'Tin Lai'
+LOGFORMAT = '%(log_color)s%(levelname)s: %(message)s%(reset)s'
+# same as backends.BACKENDS, without importing it
+BACKEND_NAMES = ('fitz', 'pdfrw')
+DEFAULT_MATCH_CACHE = os.environ.get('BOOX_HLCONVERT_MATCH_CACHE') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'boox-hlconvert', 'matches.sqlite')
 
-def convert(input_file, use_new_file=False, backup_file=True):
-    """Convert a given file's annotations."""
-    annotations = read_annotations(input_file)
-    if annotations is None:
+def convert(input_file, use_new_file=False, backup_file=True, backend='fitz',
+            incremental=False, annotations=None, stats=NULL_STATS, normalise=True, cache=None,
+            max_memory=None, sidecar=None, match_cache=None, compact=False,
+            precision=COMPACT_PRECISION, page_jobs=1):
+    """
+    Convert a given file's annotations, or apply the given sidecar (see api.convert_file),
+    and report the outcome of every annotation. Return the written file, or None if the file
+    was skipped.
+    """
+    result = convert_file(input_file, use_new_file=use_new_file, backup_file=backup_file,
+                          backend=backend, incremental=incremental, annotations=annotations,
+                          stats=stats, normalise=normalise, cache=cache,
+                          max_memory=max_memory, sidecar=sidecar, match_cache=match_cache,
+                          compact=compact, precision=precision, page_jobs=page_jobs)
+    if result.status == SKIPPED:
         _LOGGER.info("Skipping...")
         return None
-    if backup_file:
-        backup(input_file)
-    annotations = sorted(annotations, key=lambda x: x.page)
-    if use_new_file:
-        output = 'result.' + os.path.basename(input_file)
-    else:
-        output = os.path.basename(input_file)
-    output = os.path.join(os.path.dirname(input_file), output)
-
-    trailer = PdfReader(input_file)
-    fitz_pdf = PDFTextSearch(input_file)
-    for i, page in enumerate(trailer.pages):
-
-        if annotations and i == annotations[0].page:
-            page_num = i+1
-            count = 0
-            while annotations and i == annotations[0].page:
-                try:
-                    _annot = annotations.pop(0)
-                    text = _annot.text
-                    try:
-                        points = fitz_pdf.get_quadpoints(i, text)
-                    except TextNotFoundException:
-                        # use fall back to try again
-                        _LOGGER.debug("Page %d: Using fall-back mechanism."
-                                      "Might contains mistaken hls.", page_num)
-                        points = fitz_pdf.fallback_get_quadpoints(i, text)
-                    except MultipleInstancesException:
-                        _LOGGER.error("Page %d: The following text found multiple instances,\n\n"
-                                      "  --> \"%s\" <--  \n\n"
-                                      "(Token too short?), please re-highligh it manually.",
-                                      page_num, text)
-                        continue
-                    highlight = create_highlight(points,
-                                                 author=AUTHOR,
-                                                 contents=_annot.comment,
-                                                 color=(1, 1, 0.4))
-                    # check to see if this annotation exists already
-                    if fitz_pdf.annot_exists(page_num=i, annot=highlight):
-                        _LOGGER.debug("Page %d: This annot already exists, skipping...", page_num)
-                    else:
-                        add_annot(page, annot=highlight)
-                        count += 1
-                        # shorten the line by removing all \r or \n, and also remove double spacing.
-                        hightlighted = text.replace('\r', ' ').replace('\n', ' ').replace('  ', ' ')
-                        _LOGGER.info("Page %d: Highlighted:,\n"
-                                      "  --> \"%s\" <--  \n",
-                                      page_num, hightlighted)
-                except TextNotFoundException:
-                    _LOGGER.error("Page %d: The following text was not found,\n\n"
-                                  "  --> \"%s\" <--  \n\n"
-                                  "please re-highligh it manually.",
-                                  page_num, text)
-            print(">> Page {} successfully converted: {}".format(page_num, count))
-
-    PdfWriter(output, trailer=trailer).write()
-    return output
+    for warning in result.warnings:
+        _LOGGER.warning(warning)
+    report_annotations(result.annotations)
+    if compact and result.added:
+        print(">> Compact output saved about {} bytes".format(result.bytes_saved))
+    return result.output
 
-def handle_args():
-    """Handle arguments for argparse."""
+def export(input_file, sidecar_format='json', stats=NULL_STATS, cache=None, match_cache=None,
+           page_jobs=1):
+    """
+    Export a given file's highlights to a sidecar (see api.export_file), and report the
+    outcome of every annotation. Return the sidecar, or None if the file was skipped.
+    """
+    result = export_file(input_file, sidecar_format=sidecar_format, stats=stats, cache=cache,
+                         match_cache=match_cache, page_jobs=page_jobs)
+    if result.status == SKIPPED:
+        _LOGGER.info("Skipping...")
+        return None
+    report_annotations(result.annotations, verb='exported')
+    return result.output
+
+def report_annotations(results, verb='converted'):
+    """Log the outcome of every annotation, and print the number of highlights of each page."""
+    for page, page_results in groupby(results, key=lambda result: result.page):
+        page_results = list(page_results)
+        page_num = page + 1
+        if page_results[0].status == PAGE_NOT_FOUND:
+            _LOGGER.error("Page %d: Page does not exists, skipping %d annotations.",
+                          page_num, len(page_results))
+            continue
+        count = 0
+        for result in page_results:
+            text = result.text
+            if result.status == MULTIPLE_INSTANCES:
+                _LOGGER.error("Page %d: The following text found multiple instances,\n\n"
+                              "  --> \"%s\" <--  \n\n"
+                              "(Token too short?), please re-highligh it manually.",
+                              page_num, text)
+            elif result.status == NOT_FOUND:
+                _LOGGER.error("Page %d: The following text was not found,\n\n"
+                              "  --> \"%s\" <--  \n\n"
+                              "please re-highligh it manually.",
+                              page_num, text)
+            elif result.status == DUPLICATE:
+                _LOGGER.debug("Page %d: This annot already exists, skipping...", page_num)
+            else:
+                count += 1
+                # shorten the line by removing all \r or \n, and also remove double spacing.
+                hightlighted = text.replace('\r', ' ').replace('\n', ' ').replace('  ', ' ')
+                _LOGGER.info("Page %d: Highlighted:,\n"
+                             "  --> \"%s\" <--  \n",
+                             page_num, hightlighted)
+        print(">> Page {} successfully {}: {}".format(page_num, verb, count))
+
+def parse_args(argv=None, cwd=None):
+    """
+    Parse the given command line arguments (those of this process by default), the relative
+    paths being relative to cwd.
+    """
+    cwd = cwd or os.getcwd()
     parser = argparse.ArgumentParser(
         description="Convert Boox neoreader highlights annotation to standard "
                     "pdf format.")
@@ -97,7 +122,7 @@ def handle_args():
              "(without -c or -r flag) is to perform the annotation conversion "
              "action. (default: current working directory)",
         nargs='?',
-        default=os.getcwd(),
+        default=cwd,
         metavar="FILE_OR_DIR")
     parser.add_argument(
         "-c",
@@ -110,8 +135,15 @@ def handle_args():
         action='store_true',
         default=False,
         help="Cleans up the enitre directory so that any annotation directory or "
-             "bak files will be deleted; hence, implies --clean."
+             "bak files will be deleted; hence, implies --clean. Only the annotation "
+             "directories of the pdf at its top level are deleted, see --clean-entire-tree."
         )
+    parser.add_argument(
+        "--clean-entire-tree",
+        action='store_true',
+        default=False,
+        help="Same as --clean-entire-dir, but also deletes the annotation directories of the "
+             "pdf in all its subdirectories (unless --no-recursive).")
     parser.add_argument(
         "-r",
         "--restore",
@@ -129,38 +161,192 @@ def handle_args():
         action='store_true',
         default=False,
         help="Do not create a bak file (dangeous if using original file).")
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action='store_true',
+        default=False,
+        help="Append the new highlights to the pdf as an incremental update instead of "
+             "rewriting it. No bak file is created, and -r undoes the last update instead.")
+    parser.add_argument(
+        "--watch",
+        metavar="DIR",
+        help="Keep running, and convert the annotations newly appended to the annotation "
+             "files of DIR as soon as they are written. The highlights are saved "
+             "incrementally. Uses inotify if inotify_simple is installed, polling otherwise.")
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=2.0,
+        metavar="SECONDS",
+        help="Interval between polls of --watch without inotify. (default: 2)")
+    parser.add_argument(
+        "--stats",
+        metavar="JSON",
+        help="Write the time spent in every stage of the conversion, and the number of "
+             "exact hits, fallbacks, multiple instances, not found and duplicates skipped, "
+             "for each file and in total, to this json file.")
+    parser.add_argument(
+        "--include",
+        action='append',
+        default=[],
+        metavar="GLOB",
+        help="With a directory, only act on the pdf whose path relative to it matches GLOB "
+             "(e.g. 'papers/*'). May be given several times.")
+    parser.add_argument(
+        "--exclude",
+        action='append',
+        default=[],
+        metavar="GLOB",
+        help="With a directory, skip the pdf and the subdirectories whose path relative to "
+             "it matches GLOB. May be given several times.")
+    parser.add_argument(
+        "--no-recursive",
+        action='store_true',
+        default=False,
+        help="With a directory, only act on the pdf at its top level instead of those of all "
+             "its subdirectories.")
+    parser.add_argument(
+        "--force",
+        action='store_true',
+        default=False,
+        help="Convert every file of a directory, even those whose pdf and annotation file "
+             "are unchanged since their last successful conversion.")
+    parser.add_argument(
+        "--no-normalise",
+        action='store_true',
+        default=False,
+        help="Do not fix up the internal structure of the written pdf (appearance streams of "
+             "the highlights, unused objects, xref and stream compression).")
+    parser.add_argument(
+        "--compact",
+        action='store_true',
+        default=False,
+        help="Make the written highlights smaller: they refer to one shared object for each "
+             "color and author instead of holding their own copy, and their coordinates are "
+             "rounded to --precision decimals. The bytes saved are printed.")
+    parser.add_argument(
+        "--precision",
+        type=int,
+        default=COMPACT_PRECISION,
+        metavar="DIGITS",
+        help="Decimals kept of the coordinates of --compact highlights. "
+             "(default: {})".format(COMPACT_PRECISION))
+    parser.add_argument(
+        "--foxitreader",
+        action='store_true',
+        default=False,
+        help="Open every written pdf with foxitreader afterward, to re-save it by hand.")
     parser.add_argument(
         '-v',
         "--verbose",
         action='store_true',
         default=False,
         help="Be verbose in the status of conversion progress.")
+    parser.add_argument(
+        '-j',
+        "--jobs",
+        type=int,
+        default=1,
+        metavar='N',
+        help="Number of worker processes for converting the files of a directory. "
+             "(default: 1)")
+    parser.add_argument(
+        "--page-jobs",
+        type=int,
+        default=1,
+        metavar='N',
+        help="Number of worker processes searching the pages of each file, for a single "
+             "large pdf. The highlights are still written by one process, in page order, "
+             "hence the output is the same. (default: 1)")
+    parser.add_argument(
+        "--backend",
+        choices=BACKEND_NAMES,
+        default='fitz',
+        help="Library used for writing the highlights. 'fitz' parses the pdf only once, "
+             "'pdfrw' is the fallback that parses it with both libraries. (default: fitz)")
 
-    args = vars(parser.parse_args())
+    parser.add_argument(
+        "--server",
+        action='store_true',
+        default=False,
+        help="Run a conversion server, which keeps the pages of the recently converted "
+             "files in memory. Jobs are sent to it with client.py, which takes the same "
+             "arguments as this script.")
+    parser.add_argument(
+        "--socket",
+        default=DEFAULT_SOCKET,
+        help="Unix socket of the conversion server. (default: {})".format(DEFAULT_SOCKET))
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=512,
+        metavar='MB',
+        help="Memory kept for the pages of the recently converted files by the server or "
+             "the watcher. (default: 512)")
+    parser.add_argument(
+        "--export",
+        choices=('json', 'xfdf'),
+        metavar='FORMAT',
+        help="Write the highlights to a sidecar file next to the pdf (book.highlights.json "
+             "or book.xfdf) instead of writing them to the pdf, which is left untouched. "
+             "FORMAT is json or xfdf.")
+    parser.add_argument(
+        "--apply-sidecar",
+        action='store_true',
+        default=False,
+        help="Write the highlights of the sidecar file next to the pdf (as written by "
+             "--export) to the pdf, instead of searching its annotation file.")
+    parser.add_argument(
+        "--match-cache",
+        default=DEFAULT_MATCH_CACHE,
+        metavar="SQLITE",
+        help="File that remembers where every highlight was found on its page, so that "
+             "converting the same page again (after new annotations, or within another copy "
+             "of the book) does not search it again. (default: {})".format(
+                 DEFAULT_MATCH_CACHE))
+    parser.add_argument(
+        "--no-match-cache",
+        action='store_true',
+        default=False,
+        help="Search every highlight, without reading or writing the match cache.")
+    parser.add_argument(
+        "--clear-match-cache",
+        action='store_true',
+        default=False,
+        help="Empty the match cache, then exit.")
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        metavar='MB',
+        help="Low memory mode for very large pdf: every page is released once searched, and "
+             "the caches are dropped whenever the process grows over MB. The peak memory is "
+             "printed after each file.")
+
+    args = vars(parser.parse_args(argv))
+    if args['clean_entire_tree']:
+        args['clean_entire_dir'] = True
     if args['clean_entire_dir']:
         args['clean'] = True
+    for key in ('file', 'watch', 'stats', 'match_cache'):
+        if args[key]:
+            args[key] = os.path.join(cwd, args[key])
+    return args
+
+def handle_args():
+    """Handle arguments for argparse."""
+    args = parse_args()
     if args['verbose']:
         _LOGGER.setLevel(logging.DEBUG)
     else:
         _LOGGER.setLevel(logging.ERROR)
     # logger to stdout
     channel = logging.StreamHandler(sys.stdout)
-    LOGFORMAT = '%(log_color)s%(levelname)s: %(message)s%(reset)s'
     formatter = ColoredFormatter(LOGFORMAT)
     channel.setFormatter(formatter)
     _LOGGER.addHandler(channel)
     return args
 
-def backup(inpfn):
-    """Create a bak file for the given input file."""
-    backup_file = '{}.bak'.format(inpfn)
-    if os.path.isfile(backup_file):
-        _LOGGER.debug('Found backup pdf. Using the bak as input instead.')
-        shutil.copyfile(backup_file, inpfn)
-    else:
-        shutil.copyfile(inpfn, backup_file)
-
-
 def clean_up(inpfn):
     """Clean up for the given input file."""
     backup_file = '{}.bak'.format(inpfn)
@@ -180,12 +366,60 @@ def restore(inpfn, end_with_bak=False):
     elif not end_with_bak:
         _LOGGER.info("Bak file for '%s' does not exists.", inpfn)
 
-def convert_wrapper(inpfn, args):
-    """A wrapper for the convert function, for converting multiple files at once."""
-    outfn = convert(input_file=inpfn, use_new_file=args['new_file'],
-                    backup_file=(not args['no_backup']))
-    if outfn is None:
+def rollback(inpfn):
+    """
+    Restore the given input file by removing its last incremental update, if it was written
+    by this converter.
+    """
+    if truncate_last_revision(inpfn, AUTHOR):
+        _LOGGER.debug("Removed last revision of %s", inpfn)
+    else:
+        _LOGGER.info("No highlight revision of this converter to undo for '%s'.", inpfn)
+
+def max_memory(args):
+    """Return the memory ceiling of the given arguments in bytes, or None."""
+    return args['max_memory'] * 2**20 if args['max_memory'] is not None else None
+
+def match_cache(args):
+    """Return the path of the match cache of the given arguments, or None if disabled."""
+    return None if args['no_match_cache'] else args['match_cache']
+
+def record_peak_memory(stats, verbose=False):
+    """Record the peak memory of this process in stats, and print it if verbose."""
+    if not stats.enabled and not verbose:
+        return
+    from memory import peak_rss
+    peak = peak_rss()
+    if peak is None:
         return
+    stats.peak('rss_mb', peak / 2**20)
+    if verbose:
+        print(">> Peak memory: {:.0f} MB".format(peak / 2**20))
+
+def convert_wrapper(inpfn, args, stats=NULL_STATS, cache=None):
+    """A wrapper for the convert function, for converting multiple files at once."""
+    if args['export']:
+        with stats.timer('total'):
+            outfn = export(inpfn, args['export'], stats=stats, cache=cache,
+                           match_cache=match_cache(args), page_jobs=args['page_jobs'])
+        record_peak_memory(stats)
+        return outfn
+    sidecar_file = None
+    if args['apply_sidecar']:
+        from sidecar import find_sidecar, sidecar_path
+        # a missing sidecar makes the file skipped
+        sidecar_file = find_sidecar(inpfn) or sidecar_path(inpfn, 'json')
+    with stats.timer('total'):
+        outfn = convert(input_file=inpfn, use_new_file=args['new_file'],
+                        backup_file=(not args['no_backup']), backend=args['backend'],
+                        incremental=args['incremental'], stats=stats,
+                        normalise=not args['no_normalise'], cache=cache,
+                        max_memory=max_memory(args), sidecar=sidecar_file,
+                        match_cache=match_cache(args), compact=args['compact'],
+                        precision=args['precision'], page_jobs=args['page_jobs'])
+    record_peak_memory(stats, verbose=args['max_memory'] is not None and outfn is not None)
+    if outfn is None or not args['foxitreader']:
+        return outfn
     # open result file with foxitreader (to re-save the format as it helps to fixes stuff)
     # need abs path becuase using relative path does not seems to mess up saving path
     last_modified_time = os.path.getmtime(outfn)
@@ -198,45 +432,196 @@ def convert_wrapper(inpfn, args):
     if os.path.getmtime(outfn) <= last_modified_time:
         _LOGGER.warning("Seems like you did not save the file after opening foxitreader? "
                         "Its best to allow it do works for us on fixing internal PDF structures.")
+    return outfn
 
-def main():
-    """Entry point when this file is run."""
-    args = handle_args()
+def _init_worker(log_level):
+    """Initialise a worker process, its log records are captured by convert_job instead."""
+    _LOGGER.handlers = []
+    _LOGGER.setLevel(log_level)
+
+def convert_job(inpfn, args):
+    """
+    Convert a file within a worker process. Return the file name, its status, everything it
+    has printed or logged (so that the output of each file stays grouped together) and its
+    stats.
+    """
+    stats = Stats() if args['stats'] else NULL_STATS
+    buffer = io.StringIO()
+    channel = logging.StreamHandler(buffer)
+    channel.setFormatter(ColoredFormatter(LOGFORMAT))
+    _LOGGER.addHandler(channel)
+    try:
+        with contextlib.redirect_stdout(buffer):
+            outfn = convert_wrapper(inpfn, args, stats=stats)
+        status = 'skipped' if outfn is None else 'ok'
+    except Exception as err:  # one bad file must not stop the others
+        _LOGGER.exception("Failed to convert %s", inpfn)
+        status = 'failed: {}'.format(err)
+    finally:
+        _LOGGER.removeHandler(channel)
+    return inpfn, status, buffer.getvalue(), stats.as_dict()
+
+def convert_parallel(files, args, manifest, unchanged, report):
+    """
+    Convert the given files with a pool of worker processes, then print a summary. Return the
+    number of files that failed.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    summary = [(file, 'unchanged') for file in unchanged]
+    with ProcessPoolExecutor(max_workers=args['jobs'], initializer=_init_worker,
+                             initargs=(_LOGGER.level,)) as executor:
+        futures = [executor.submit(convert_job, file, args) for file in files]
+        for future in as_completed(futures):
+            file, status, output, stats = future.result()
+            print('='*80)
+            print(' {}'.format(os.path.basename(file)))
+            print('-'*80)
+            print(output)
+            if status == 'ok':
+                if uses_manifest(args):
+                    manifest.record(file)
+                report.add(file, stats)
+            summary.append((file, status))
+    print('='*80)
+    print(' Summary: {} converted, {} unchanged, {} skipped, {} failed'.format(
+        sum(status == 'ok' for _, status in summary),
+        sum(status == 'unchanged' for _, status in summary),
+        sum(status == 'skipped' for _, status in summary),
+        sum(status.startswith('failed') for _, status in summary)))
+    print('-'*80)
+    for file, status in sorted(summary):
+        print(' {:<60} {}'.format(os.path.basename(file), status))
+    return sum(status.startswith('failed') for _, status in summary)
+
+def uses_manifest(args):
+    """
+    Return True if the manifest applies to the given arguments. It only knows about the
+    annotation files, not the sidecars, and exporting or writing a new file leaves the pdf as
+    it was.
+    """
+    return not args['export'] and not args['apply_sidecar'] and not args['new_file']
+
+def convert_files(files, args, manifest, report, cache=None):
+    """
+    Convert the given files of a directory, except those that are unchanged since their last
+    successful conversion according to the manifest (unless forced). Return the number of
+    files that failed, a failure being raised unless converting in parallel.
+    """
+    unchanged = []
+    if uses_manifest(args) and not args['force']:
+        unchanged = [f for f in files if manifest.is_unchanged(f)]
+    files = [f for f in files if f not in unchanged]
+    if args['jobs'] > 1:
+        return convert_parallel(files, args, manifest, unchanged, report)
+    for file in files:
+        # Main functionality
+        print('='*80)
+        print(' {}'.format(os.path.basename(file)))
+        print('-'*80)
+        stats = Stats() if args['stats'] else NULL_STATS
+        if convert_wrapper(file, args, stats=stats, cache=cache) is not None:
+            if uses_manifest(args):
+                manifest.record(file)
+            report.add(file, stats.as_dict())
+        print('')
+    if unchanged:
+        print(' Skipped {} unchanged file(s), use --force to convert them anyway.'.format(
+            len(unchanged)))
+    return 0
+
+def watch(root, args):
+    """Convert the annotations appended to the annotation files of root, until interrupted."""
+    def convert_new(inpfn, annotations):
+        """Append the highlights of the new annotations to the pdf."""
+        convert(input_file=inpfn, backup_file=False, backend=args['backend'],
+                incremental=True, annotations=annotations,
+                normalise=not args['no_normalise'], cache=cache,
+                max_memory=max_memory(args), match_cache=match_cache(args),
+                compact=args['compact'], precision=args['precision'])
+        manifest.record(inpfn)
+    from manifest import ConversionManifest
+    from watch import AnnotationWatcher
+    from document_cache import DocumentCache
+    cache = DocumentCache(args['cache_mb'] * 2**20)
+    manifest = ConversionManifest(root)
+    try:
+        AnnotationWatcher(root, manifest, convert_new,
+                          poll_interval=args['poll_interval']).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manifest.close()
+
+def run(args, cache=None):
+    """Run the action of the given parsed arguments. Return the exit status."""
     if args['clean'] == args['restore'] and args['clean']:
         _LOGGER.error("The flag -c and -r are mutually exclusive, cannot be both set!")
-        sys.exit(1)
+        return 1
+    if args['clear_match_cache']:
+        from match_cache import MatchCache
+        cache_file = MatchCache(args['match_cache'])
+        cache_file.clear()
+        cache_file.close()
+        return 0
+    if args['watch']:
+        watch(os.path.abspath(args['watch']), args)
+        return 0
     inpfn = os.path.abspath(args['file'])
+    report = StatsReport()
+    failed = 0
 
     # for clean up or restore
     if os.path.isdir(inpfn):
-        for file in os.listdir(inpfn):
-            # prefix the file name with its directory
-            file = os.path.join(inpfn, file)
-            if file.endswith(".bak") and args['restore']:
-                restore(file, end_with_bak=True)
-            elif file.endswith(".pdf"):
-                if args['clean_entire_dir']:
-                    annot_path = os.path.splitext(file)[0]
-                    if os.path.isdir(annot_path):
-                        _LOGGER.debug("Deleting annot dir %s", annot_path)
-                        shutil.rmtree(annot_path)
-                if args['clean']:
-                    clean_up(file)
-                elif not args['clean'] and not args['restore']:
-                    # Main functionality
-                    print('='*80)
-                    print(' {}'.format(os.path.basename(file)))
-                    print('-'*80)
-                    convert_wrapper(file, args)
-                    print('')
+        pending = []
+        for item in discover(inpfn, include=args['include'], exclude=args['exclude'],
+                             recursive=not args['no_recursive']):
+            # only the folders that hold an annotation file, deep ones if asked for
+            if (args['clean_entire_dir'] and item.annotation_file and
+                    (args['clean_entire_tree'] or os.path.dirname(item.pdf_path) == inpfn)):
+                _LOGGER.debug("Deleting annot dir %s", item.annotation_dir)
+                shutil.rmtree(item.annotation_dir)
+            if args['clean']:
+                if item.backup_file:
+                    clean_up(item.pdf_path)
+            elif args['restore'] and args['incremental']:
+                if item.exists:
+                    rollback(item.pdf_path)
+            elif args['restore']:
+                if item.backup_file:
+                    restore(item.backup_file, end_with_bak=True)
+            elif item.convertible(sidecar=args['apply_sidecar']):
+                pending.append(item.pdf_path)
+        if pending:
+            from manifest import ConversionManifest
+            manifest = ConversionManifest(inpfn)
+            try:
+                failed = convert_files(pending, args, manifest, report, cache=cache)
+            finally:
+                manifest.close()
     else:
         if args['clean']:
             clean_up(inpfn)
+        elif args['restore'] and args['incremental']:
+            rollback(inpfn)
         elif args['restore']:
             restore(inpfn)
         else:
             # Main functionality
-            convert_wrapper(inpfn, args)
+            stats = Stats() if args['stats'] else NULL_STATS
+            if convert_wrapper(inpfn, args, stats=stats, cache=cache) is not None:
+                report.add(inpfn, stats.as_dict())
+    if args['stats']:
+        report.write(args['stats'])
+    return 1 if failed else 0
+
+def main():
+    """Entry point when this file is run."""
+    args = handle_args()
+    if args['server']:
+        from server import ConversionServer
+        server = ConversionServer(args['socket'], cache_bytes=args['cache_mb'] * 2**20)
+        sys.exit(server.serve_forever())
+    sys.exit(run(args))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,72 @@
+"""
+For remembering the inputs of every successful conversion, so that unchanged files are skipped.
+"""
+import os
+import sqlite3
+
+from boox_annot_reader import annotation_path
+
+MANIFEST_NAME = '.boox-hlconvert.sqlite'
+
+
+class ConversionManifest:
+    """
+    Represent the manifest stored in the root of a library. For every converted pdf it keeps
+    the size and modification time of the pdf (as written by the conversion) and of its
+    annotation file. For watch mode, it also keeps how far each annotation file was processed.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.conn = sqlite3.connect(os.path.join(root, MANIFEST_NAME))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS conversions ("
+                          "pdf TEXT PRIMARY KEY, "
+                          "pdf_size INTEGER, pdf_mtime INTEGER, "
+                          "annot_size INTEGER, annot_mtime INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS watch_state ("
+                          "annot TEXT PRIMARY KEY, offset INTEGER, count INTEGER)")
+
+    def _key(self, path):
+        """Return the key of the given file, which is its path relative to the library root."""
+        return os.path.relpath(path, self.root)
+
+    @staticmethod
+    def signature(pdf_path):
+        """Return the (size, mtime) of the given pdf and of its annotation file."""
+        pdf_stat = os.stat(pdf_path)
+        try:
+            annot_stat = os.stat(annotation_path(pdf_path))
+        except FileNotFoundError:
+            return pdf_stat.st_size, pdf_stat.st_mtime_ns, None, None
+        return (pdf_stat.st_size, pdf_stat.st_mtime_ns,
+                annot_stat.st_size, annot_stat.st_mtime_ns)
+
+    def is_unchanged(self, pdf_path):
+        """Determine if the inputs of the given pdf are the same as its last conversion."""
+        row = self.conn.execute(
+            "SELECT pdf_size, pdf_mtime, annot_size, annot_mtime FROM conversions "
+            "WHERE pdf = ?", (self._key(pdf_path),)).fetchone()
+        return row is not None and tuple(row) == self.signature(pdf_path)
+
+    def record(self, pdf_path):
+        """Record the current inputs of the given pdf as successfully converted."""
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?)",
+                              (self._key(pdf_path),) + self.signature(pdf_path))
+
+    def watch_state(self, annotation_file_name):
+        """Return the (byte offset, annotation count) already processed of an annotation file."""
+        row = self.conn.execute(
+            "SELECT offset, count FROM watch_state WHERE annot = ?",
+            (self._key(annotation_file_name),)).fetchone()
+        return tuple(row) if row is not None else (0, 0)
+
+    def set_watch_state(self, annotation_file_name, offset, count):
+        """Record the (byte offset, annotation count) already processed of an annotation file."""
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO watch_state VALUES (?, ?, ?)",
+                              (self._key(annotation_file_name), offset, count))
+
+    def close(self):
+        """Close the manifest."""
+        self.conn.close()
@@ -0,0 +1,161 @@
+"""
+For remembering, across runs, where every highlight text was found on its page. A match is
+keyed by the fingerprint of the page content and the normalised text, so it is reused when
+the annotation file only gained new entries, and for the same page within another file
+(another copy or edition of the book).
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+from page_text_index import PageTextIndex
+from helper import RectBatch
+from pdf_text_search import (
+    TextNotFoundException,
+    FallbackFailedException,
+    MultipleInstancesException,
+)
+
+DEFAULT_MAX_BYTES = 32 * 2**20
+# part of every page fingerprint, bump it whenever the search gives other results for the
+# same page and text, so that the matches of the older search are never reused
+MATCHER_VERSION = 1
+
+# outcome of a cached match, and the exception that it is rebuilt into
+FOUND = 'found'
+EXCEPTIONS = {
+    'not_found': TextNotFoundException,
+    'fallback_failed': FallbackFailedException,
+    'multiple_instances': MultipleInstancesException,
+}
+OUTCOMES = {exception: outcome for outcome, exception in EXCEPTIONS.items()}
+
+
+def page_fingerprint(doc, page_num):
+    """
+    Return the fingerprint of the content of a page: its boxes, rotation, content streams and
+    form xobjects (which may hold its text), but not its annotations.
+    """
+    page = doc[page_num]
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((MATCHER_VERSION, tuple(page.MediaBox), tuple(page.rect),
+                        page.rotation)).encode('ascii'))
+    digest.update(page.readContents())
+    for xref, *_ in doc.getPageXObjectList(page_num):
+        digest.update(doc.xrefStream(xref) or b'')
+    return digest.hexdigest()
+
+
+class MatchCache:
+    """
+    Represent the match cache stored in a sqlite file. For every (page fingerprint, normalised
+    text) it keeps the outcome of the search, the quadpoints found (or the error message) and
+    the method used. The least recently used matches are evicted once the stored matches
+    exceed max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # several processes may convert at once (-j, or the server along with a script)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS matches ("
+                          "page TEXT, text TEXT, outcome TEXT, method TEXT, value TEXT, "
+                          "size INTEGER, used INTEGER, PRIMARY KEY (page, text))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS matches_used ON matches (used)")
+
+    def lookup(self, page, texts):
+        """
+        Return {text: (quadpoints or exception, method)} of the given texts whose match is
+        cached for the given page fingerprint, and mark those matches as used.
+        """
+        found = {}
+        with self.conn:
+            for text in set(texts):
+                key = PageTextIndex.normalise(text)
+                row = self.conn.execute(
+                    "SELECT outcome, method, value FROM matches WHERE page = ? AND text = ?",
+                    (page, key)).fetchone()
+                if row is None:
+                    continue
+                outcome, method, value = row
+                if outcome == FOUND:
+                    points = RectBatch(json.loads(value))
+                else:
+                    points = EXCEPTIONS[outcome](value)
+                found[text] = (points, method)
+                self.conn.execute("UPDATE matches SET used = ? WHERE page = ? AND text = ?",
+                                  (time.time_ns(), page, key))
+        self.hits += len(found)
+        self.misses += len(set(texts)) - len(found)
+        return found
+
+    def page_quadpoints(self, searcher, page_num, texts, stats):
+        """
+        Same as searcher.get_page_quadpoints, only the texts that are not cached for the page
+        being searched. Their matches are then stored.
+        """
+        page = page_fingerprint(searcher.doc, page_num)
+        found = self.lookup(page, texts)
+        stats.incr('match_cache_hits', len(found))
+        for points, _method in found.values():
+            if isinstance(points, MultipleInstancesException):
+                stats.incr('multiple_instances')
+            elif isinstance(points, TextNotFoundException):
+                stats.incr('not_found')
+        missing = [text for text in dict.fromkeys(texts) if text not in found]
+        if missing:
+            matches = searcher.get_page_quadpoints(page_num, missing)
+            self.store(page, [(text, points, method)
+                              for text, (points, method) in zip(missing, matches)])
+            found.update(zip(missing, matches))
+        return [found[text] for text in texts]
+
+    def store(self, page, matches):
+        """Store the given [(text, quadpoints or exception, method)] of a page fingerprint."""
+        rows = []
+        for text, points, method in matches:
+            if isinstance(points, Exception):
+                outcome, value = OUTCOMES.get(type(points)), str(points)
+                if outcome is None:  # not an outcome of the search
+                    continue
+            else:
+                outcome, value = FOUND, json.dumps(RectBatch(points).array.tolist())
+            key = PageTextIndex.normalise(text)
+            rows.append((page, key, outcome, method, value,
+                         len(page) + len(key) + len(value), time.time_ns()))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  rows)
+
+    def nbytes(self):
+        """Return the approximate size of the stored matches in bytes."""
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM matches").fetchone()[0]
+
+    def trim(self):
+        """Evict the least recently used matches until the cache fits within max_bytes."""
+        if self.nbytes() <= self.max_bytes:
+            return
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM matches WHERE rowid IN (SELECT rowid FROM ("
+                "SELECT rowid, SUM(size) OVER (ORDER BY used DESC) AS total FROM matches) "
+                "WHERE total > ?)", (self.max_bytes,))
+
+    def clear(self):
+        """Invalidate every match."""
+        with self.conn:
+            self.conn.execute("DELETE FROM matches")
+        self.conn.execute("VACUUM")
+
+    def close(self):
+        """Trim the cache, and close it."""
+        self.trim()
+        self.conn.close()
+
@@ -0,0 +1,39 @@
+"""
+For measuring the memory used by this process, and keeping it under a ceiling.
+"""
+import os
+import sys
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """Return the peak resident memory of this process in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss():
+    """Return the resident memory of this process in bytes, or its peak if unknown."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return peak_rss()
+
+
+class MemoryCeiling:
+    """Represent the resident memory that a conversion should stay under."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+    def exceeded(self):
+        """Return True if the process uses more memory than the ceiling."""
+        rss = current_rss()
+        return rss is not None and rss > self.max_bytes
@@ -0,0 +1,71 @@
+"""
+For indexing the layout of a pdf page (text blocks, lines and columns), so that the geometry
+checks of every search on that page share one analysis.
+"""
+import bisect
+import numpy as np
+
+# lines wider than this share of the text area span several columns (e.g. titles)
+SPANNING_LINE_RATIO = 0.6
+# narrowest horizontal gap between lines that separates two columns
+MIN_COLUMN_GAP = 8
+
+
+class PageLayout:
+    """
+    Represent the layout of a page: its text blocks (in reading order, and sorted by top for
+    bisect lookups), its line boxes sorted by top, and the x coordinates of the boundaries
+    between its columns, sorted as well. Any number of columns is detected.
+    """
+
+    def __init__(self, block_rects, line_rects):
+        self.blocks = np.asarray(block_rects, dtype=float).reshape(-1, 4)
+        self._blocks_by_top = np.argsort(self.blocks[:, 1], kind='stable')
+        self._block_tops = self.blocks[self._blocks_by_top, 1].tolist()
+        lines = np.asarray(line_rects, dtype=float).reshape(-1, 4)
+        self.lines = lines[np.argsort(lines[:, 1], kind='stable')]
+        self.column_bounds = self._detect_columns(self.lines)
+
+    @staticmethod
+    def _detect_columns(lines):
+        """
+        Return the sorted x coordinates that separate the columns, which are the gaps of the
+        horizontal extent of the lines that are not spanning several columns.
+        """
+        if not len(lines):
+            return []
+        text_width = lines[:, 2].max() - lines[:, 0].min()
+        narrow = lines[lines[:, 2] - lines[:, 0] <= SPANNING_LINE_RATIO * text_width]
+        bounds = []
+        reach = None
+        for x0, x1 in sorted(narrow[:, [0, 2]].tolist()):
+            if reach is not None and x0 - reach >= MIN_COLUMN_GAP:
+                bounds.append((reach + x0) / 2)
+            reach = x1 if reach is None else max(reach, x1)
+        return bounds
+
+    @property
+    def column_count(self):
+        """Return the number of columns of the page."""
+        return len(self.column_bounds) + 1
+
+    def columns_of(self, rects):
+        """Return the column (0-based, from the left) of the center of each given rect."""
+        rects = np.asarray(rects, dtype=float).reshape(-1, 4)
+        return np.searchsorted(self.column_bounds, (rects[:, 0] + rects[:, 2]) / 2,
+                               side='right')
+
+    def containing_blocks(self, rects):
+        """
+        Return, for each given rect, the reading order index of the first block that contains
+        it, or -1 if none does. Only the blocks whose top is above the rect are checked.
+        """
+        rects = np.asarray(rects, dtype=float).reshape(-1, 4)
+        result = np.full(len(rects), -1)
+        for k, (x0, y0, x1, y1) in enumerate(rects.tolist()):
+            candidates = self._blocks_by_top[:bisect.bisect_right(self._block_tops, y0)]
+            blocks = self.blocks[candidates]
+            inside = ((blocks[:, 0] <= x0) & (blocks[:, 2] >= x1) & (blocks[:, 3] >= y1))
+            if inside.any():
+                result[k] = candidates[inside].min()
+        return result
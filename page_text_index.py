@@ -0,0 +1,247 @@
+"""
+For indexing the text of a pdf page, so that every search on that page shares one extraction.
+"""
+import unicodedata
+from collections import Counter, defaultdict
+import fitz
+
+from page_layout import PageLayout
+
+NGRAM_SIZE = 4
+# n-grams that occur more often than this on a page are useless as anchors
+NGRAM_MAX_HITS = 64
+FUZZY_MIN_SIMILARITY = 0.8
+# characters that an alignment may stray from the path through its anchors, on top of the
+# drift between the anchors around it
+ALIGN_BAND = 8
+# characters of a highlight that may stand for any character of the page
+WILDCARDS = frozenset('\ufffd?')
+# the default flags of rawdict without TEXT_PRESERVE_IMAGES, as the images are never used but
+# would be decoded and copied (every page of a scanned book is one)
+RAWDICT_FLAGS = (fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE |
+                 fitz.TEXT_MEDIABOX_CLIP)
+
+
+class PageTextIndex:
+    """
+    Represent the character stream of a single page. The stream is normalised (compatibility
+    decomposed so that ligatures are split, lower case, whitespace collapsed into a single
+    space) and every character keeps the box and the line that it comes from, so that a match
+    in the stream can be turned back into rects. The boxes of the text blocks and lines are
+    kept as well, for the layout of the page.
+    """
+
+    def __init__(self, page):
+        chars = []
+        boxes = []
+        line_ids = []
+        line_no = 0
+        self.block_rects = []
+        self.line_rects = []
+        for block in page.getText('rawdict', flags=RAWDICT_FLAGS)['blocks']:
+            if block['type'] != 0:
+                # not a text block (e.g. image)
+                continue
+            self.block_rects.append(block['bbox'])
+            for line in block['lines']:
+                self.line_rects.append(line['bbox'])
+                for span in line['spans']:
+                    for char in span['chars']:
+                        if char['c'].isspace():
+                            self._add_space(chars, boxes, line_ids)
+                            continue
+                        for c in unicodedata.normalize('NFKC', char['c']).lower():
+                            chars.append(c)
+                            boxes.append(char['bbox'])
+                            line_ids.append(line_no)
+                # line break is equivalent to a space
+                self._add_space(chars, boxes, line_ids)
+                line_no += 1
+        self.text = ''.join(chars)
+        self.boxes = boxes
+        self.line_ids = line_ids
+        self._ngrams = None
+        self._layout = None
+
+    def layout(self):
+        """Return the layout of the page, built once."""
+        if self._layout is None:
+            self._layout = PageLayout(self.block_rects, self.line_rects)
+        return self._layout
+
+    @staticmethod
+    def _add_space(chars, boxes, line_ids):
+        """Add a space to the stream, unless the stream already ends with one."""
+        if chars and chars[-1] != ' ':
+            chars.append(' ')
+            boxes.append(None)
+            line_ids.append(None)
+
+    @staticmethod
+    def normalise(text):
+        """Normalise the given text the same way as the page stream."""
+        return ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+
+    def find(self, text):
+        """Return the (start, end) span in the stream of every occurrence of the given text."""
+        needle = self.normalise(text)
+        spans = []
+        if not needle:
+            return spans
+        start = self.text.find(needle)
+        while start >= 0:
+            spans.append((start, start + len(needle)))
+            start = self.text.find(needle, start + len(needle))
+        return spans
+
+    def span_rects(self, start, end):
+        """Return one rect per line for the characters within the given span of the stream."""
+        rects = []
+        current_line = None
+        for box, line_id in zip(self.boxes[start:end], self.line_ids[start:end]):
+            if box is None:
+                continue
+            if line_id != current_line:
+                rects.append(fitz.Rect(box))
+                current_line = line_id
+            else:
+                rects[-1] |= box
+        return rects
+
+    def search(self, text, hit_max=16):
+        """Search for the given text, and return the rects of at most hit_max lines hit."""
+        rects = []
+        for start, end in self.find(text):
+            rects.extend(self.span_rects(start, end))
+        return rects[:hit_max]
+
+    def ngram_index(self):
+        """Return the positions in the stream of every n-gram, built once."""
+        if self._ngrams is None:
+            self._ngrams = defaultdict(list)
+            for i in range(len(self.text) - NGRAM_SIZE + 1):
+                self._ngrams[self.text[i:i+NGRAM_SIZE]].append(i)
+        return self._ngrams
+
+    def fuzzy_find(self, text, min_similarity=FUZZY_MIN_SIMILARITY):
+        """
+        Find the spans of the stream that are close to the given text, even with hyphenation,
+        ligatures or placeholder characters in either of them. The n-grams of the text vote for
+        the diagonal (offset between the text and the stream) they are anchored at, then the
+        text is aligned along the n-grams found around the best diagonals. Return the (start,
+        end) span of every alignment that is similar enough, more than one means the text is
+        ambiguous.
+        """
+        needle = self.normalise(text)
+        if len(needle) < NGRAM_SIZE:
+            return []
+        votes = Counter()
+        for i in range(len(needle) - NGRAM_SIZE + 1):
+            for pos in self._anchor_positions(needle, i):
+                votes[pos - i] += 1
+        if not votes:
+            return []
+        # how far the diagonals of one instance may spread
+        band = max(ALIGN_BAND, len(needle) // 8)
+
+        def cluster_votes(diagonal):
+            """Total votes of the diagonals within the band of the given one."""
+            return sum(count for other, count in votes.items() if abs(other - diagonal) <= band)
+        candidates = sorted((d for d, _ in votes.most_common(8)), key=cluster_votes, reverse=True)
+        best = candidates[0]
+        diagonals = [best]
+        # the best other instance is far enough from the best one not to overlap
+        others = [d for d in candidates[1:] if abs(d - best) >= len(needle) // 2]
+        if others and cluster_votes(others[0]) >= 0.8 * cluster_votes(best):
+            diagonals.append(others[0])
+
+        spans = []
+        for diagonal in diagonals:
+            anchors = self._anchors(needle, diagonal, band)
+            start, end, distance = self._align(needle, anchors)
+            if 1 - distance / len(needle) >= min_similarity:
+                spans.append((start, end))
+        return spans
+
+    def _anchor_positions(self, needle, i):
+        """Return the positions in the stream of the n-gram of the needle at i, if few enough."""
+        positions = self.ngram_index().get(needle[i:i+NGRAM_SIZE], ())
+        return positions if len(positions) <= NGRAM_MAX_HITS else ()
+
+    def _anchors(self, needle, diagonal, band):
+        """
+        Return the [(needle position, diagonal)] of the n-grams of the needle that are found
+        within band of the given diagonal, in order in both the needle and the stream. An
+        anchor may only drift from the previous one by as many characters as lie between them.
+        """
+        anchors = []
+        prev_i, prev_pos, prev_diagonal = 0, -1, diagonal
+        for i in range(len(needle) - NGRAM_SIZE + 1):
+            gap = max(ALIGN_BAND, i - prev_i)
+            best = None
+            for pos in self._anchor_positions(needle, i):
+                drift = abs(pos - i - prev_diagonal)
+                if (pos > prev_pos and abs(pos - i - diagonal) <= band and drift <= gap and
+                        (best is None or drift < abs(best - i - prev_diagonal))):
+                    best = pos
+            if best is not None:
+                anchors.append((i, best - i))
+                prev_i, prev_pos, prev_diagonal = i, best, best - i
+        return anchors or [(0, diagonal)]
+
+    def _align(self, needle, anchors):
+        """
+        Align the whole needle against the stream along the given anchors (see _anchors),
+        allowing its start and end to be anywhere in the stream. Between two anchors the
+        alignment follows the line through them, and may stray from it by ALIGN_BAND plus the
+        drift between them, so that the cost grows linearly with the needle. Return the (start,
+        end) span in the stream and the edit distance.
+        """
+        # the diagonal and the band of every row of the alignment
+        centres = [anchors[0][1]] * (len(needle) + 1)
+        widths = [ALIGN_BAND] * (len(needle) + 1)
+        for (i, diagonal), (next_i, next_diagonal) in zip(anchors, anchors[1:]):
+            drift = next_diagonal - diagonal
+            for row in range(i, next_i):
+                centres[row] = diagonal + drift * (row - i) // (next_i - i)
+                widths[row] = ALIGN_BAND + abs(drift)
+        last_i, last_diagonal = anchors[-1]
+        for row in range(last_i, len(needle) + 1):
+            centres[row] = last_diagonal
+        text = self.text
+        inf = float('inf')
+
+        def columns(row):
+            """Return the first and last stream positions of a row of the alignment."""
+            return (max(0, row + centres[row] - widths[row]),
+                    min(len(text), row + centres[row] + widths[row]))
+        # row 0: the needle can start anywhere for free
+        prev_lo, prev_hi = columns(0)
+        prev = [0] * max(0, prev_hi - prev_lo + 1)
+        prev_start = list(range(prev_lo, prev_hi + 1))
+        for i, char in enumerate(needle, 1):
+            lo, hi = columns(i)
+            cur = [inf] * max(0, hi - lo + 1)
+            cur_start = [0] * len(cur)
+            for j in range(lo, hi + 1):
+                k = j - prev_lo
+                # the needle character is missing from the stream
+                if 0 <= k < len(prev):
+                    best, start = prev[k] + 1, prev_start[k]
+                else:
+                    best, start = inf, 0
+                if 0 < k <= len(prev):
+                    cost = 0 if char == text[j-1] or char in WILDCARDS else 1
+                    if prev[k-1] + cost < best:
+                        best, start = prev[k-1] + cost, prev_start[k-1]
+                # the stream character is missing from the needle
+                if j > lo and cur[j-lo-1] + 1 < best:
+                    best, start = cur[j-lo-1] + 1, cur_start[j-lo-1]
+                cur[j-lo] = best
+                cur_start[j-lo] = start
+            prev, prev_start, prev_lo = cur, cur_start, lo
+        if not prev:
+            # the needle runs past the end of the stream
+            return 0, 0, inf
+        end = min(range(len(prev)), key=prev.__getitem__)
+        return prev_start[end], prev_lo + end, prev[end]
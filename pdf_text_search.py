@@ -3,12 +3,24 @@ For searching text in a pdf file.
 """
 import logging
 import fitz
-from helper import pdfrw_quadpoint_to_fitz_rect
+import numpy as np
+from helper import RectBatch, pdfrw_quadpoint_to_fitz_rect
+from page_text_index import PageTextIndex
+from spatial_index import RectGrid, overlap_ratio
+from stats import NULL_STATS
+from document_cache import PageCache
 
-_LOGGER = logging.getLogger()
+_LOGGER = logging.getLogger(__name__)
 
-TOKENS_MIN_LENGTH = 2
 SAME_LINE_TOL = 1.5
+# how much every line of a highlight must overlap (intersection over union) the line of one
+# added earlier in the same run to be the same highlight
+SAME_HIGHLIGHT_OVERLAP = 0.8
+
+# how a text was matched against its page
+METHOD_EXACT = 'exact'
+METHOD_FALLBACK = 'fallback'
+
 
 class TextNotFoundException(Exception):
     """Exception for text not found in pdf."""
@@ -18,7 +30,7 @@ class MultipleInstancesException(Exception):
     """Exception for multiple possible instances found in pdf."""
     pass
 
-class FallbackFailedException(Exception):
+class FallbackFailedException(TextNotFoundException):
     """Exception for fallback method of pdf text search fails as well."""
     pass
 
@@ -29,13 +41,71 @@ class PossibleErrorException(Exception):
 class PDFTextSearch:
     """Represent a class that search text from a pdf."""
 
-    def __init__(self, doc_name):
+    def __init__(self, doc_name, stats=NULL_STATS, page_cache=None):
         self.doc = fitz.open(doc_name)
+        self.stats = stats
+        if page_cache is None:
+            page_cache = PageCache()
+        # kept apart from the annotations, these can be shared with a later search of the pdf
+        self._page_indexes = page_cache.page_indexes
+        self._page_heights = page_cache.page_heights
+        self._annot_indexes = {}
+        self._added_indexes = {}
+
+    def page_index(self, page_num):
+        """Return the text index of given page, which is built once and cached."""
+        if page_num not in self._page_indexes:
+            with self.stats.timer('page_index'):
+                self._page_indexes[page_num] = PageTextIndex(self.doc[page_num])
+        return self._page_indexes[page_num]
+
+    def release_page(self, page_num):
+        """Drop the text index of the given page, it is rebuilt if searched again."""
+        self._page_indexes.pop(page_num, None)
+
+    def release_memory(self):
+        """Drop all the text indexes, and the resources decoded by MuPDF (fonts, images)."""
+        self._page_indexes.clear()
+        fitz.TOOLS.store_shrink(100)
+
+    def get_page_quadpoints(self, page_num, texts):
+        """
+        Search for all the given texts in the page, using the fallback method for the texts
+        that cannot be found directly. All searches are resolved against the same page index.
+        Return a list that holds, for each text, either its quadpoints or the exception raised,
+        and the last method used (METHOD_EXACT or METHOD_FALLBACK).
+        """
+        stats = self.stats
+        results = []
+        for text in texts:
+            method = METHOD_EXACT
+            try:
+                try:
+                    with stats.timer('search'):
+                        points = self.get_quadpoints(page_num, text)
+                    stats.incr('exact_hits')
+                except TextNotFoundException:
+                    # use fall back to try again
+                    _LOGGER.debug("Page %d: Using fall-back mechanism."
+                                  "Might contains mistaken hls.", page_num + 1)
+                    stats.incr('fallbacks')
+                    method = METHOD_FALLBACK
+                    with stats.timer('fallback'):
+                        points = self.fallback_get_quadpoints(page_num, text)
+                    stats.incr('fallback_hits')
+            except TextNotFoundException as err:
+                stats.incr('not_found')
+                points = err
+            except MultipleInstancesException as err:
+                stats.incr('multiple_instances')
+                points = err
+            results.append((points, method))
+        return results
 
     def get_quadpoints(self, page_num, text, hit_max=16, ignore_short_width=4, extract=True):
         """Search for the given text in the page. Raise exception if more than one result found"""
-        page = self.doc[page_num]
-        rects = page.searchFor(text, hit_max=hit_max)
+        index = self.page_index(page_num)
+        rects = index.search(text, hit_max=hit_max)
         if len(rects) < 1:
             raise TextNotFoundException("No search result found: {}".format(text))
         if len(rects) > 1:
@@ -44,184 +114,173 @@ class PDFTextSearch:
             # it is most likely it is a single result with multiline spanning. If not,
             # most likely the searching text is too short and result in many lines having
             # the same sequence of word.
-            textblock = page.getTextBlocks()
-            consecutive_results = None
-            i = 0
-            for textblock in page.getTextBlocks():
-                if i >= len(rects):
-                    break  # DONE
-                textblock_rect = fitz.Rect(textblock[0], textblock[1], textblock[2], textblock[3])
-                # print(dir(textblock_rect))
-                # print(type(textblock_rect))
-                if textblock_rect.includeRect(rects[i]):
-                    while i < len(rects):
-                        if rects[i].width < ignore_short_width:
-                            # Do not include this short line in highlighting
-                            rects.pop(i)
-                        if consecutive_results is None:
-                            consecutive_results = 'started'
-                        elif consecutive_results == 'end':
-                            raise MultipleInstancesException(
-                                "Possible multiple search results. The results are not consecutive")
-                        # 'FOUNDDDDD!!!!!!
-                        i += 1
-                        if i >= len(rects) or not textblock_rect.includeRect(rects[i]):
-                            break
-                else:
-                    if consecutive_results == 'started':
-                        consecutive_results = 'end'
-
-            # if reaching this point, all result must have been matched. If not, error
-            if i < len(rects):
-                raise PossibleErrorException("ERROR! Not all result been vertified.")
+            rects = self.check_consecutive(index.layout(), rects, ignore_short_width)
         if not extract:
             return rects
-        merged = self.merge_tokens(rects)
+        merged = self.merge_tokens(rects, index.layout())
         return self.invert_coordinates(merged, self.page_height(page_num))
 
+    @staticmethod
+    def check_consecutive(layout, rects, ignore_short_width=4):
+        """
+        Check that the given result lines lie within consecutive text blocks of the page (in
+        reading order), and return them without the lines shorter than ignore_short_width.
+        """
+        blocks = layout.containing_blocks(RectBatch(rects).array)
+        if (blocks < 0).any():
+            raise PossibleErrorException("ERROR! Not all result been vertified.")
+        steps = np.diff(blocks)
+        if (steps < 0).any():
+            raise PossibleErrorException("ERROR! Not all result been vertified.")
+        if (steps > 1).any():
+            raise MultipleInstancesException(
+                "Possible multiple search results. The results are not consecutive")
+        # Do not include the short lines in highlighting
+        return [rect for rect in rects if rect.width >= ignore_short_width]
 
-    def fallback_get_quadpoints(self, page_num, text, hit_max=16, ignore_short_width=4):
+    def fallback_get_quadpoints(self, page_num, text):
         """
-        Search for the given text in the page. Raise exception if more than one result found.
-        This fallback method breaks the entire text into chunks of tokens, and ignore tokens that
-        cannot be recognised. Therefore, it is more robust as it ignores a part of tokens for
-        better finding text, and also does its best to detect error.
+        Search for the given text in the page, when it cannot be found exactly. This fallback
+        method aligns the entire text against the page text in one pass, tolerating the
+        characters that differ (hyphenation, ligatures, unrecognised tokens) anywhere in the
+        text. Raise exception if no close enough match or more than one result found.
         """
-        tokens = []
-        def add(words):
-            """Helper functino to add w to tokens (and check length before doing so)"""
-            if len(words) <= 2:
-                _LOGGER.debug("VERY SHORT token: '%s'! Ignoring this token...", words)
-                return
-            tokens.extend(self.get_quadpoints(page_num, words, hit_max,
-                                              ignore_short_width, extract=False))
-        def get_token(line):
-            """Given line, return the splited sentence before and after the first
-            occurance of an escape char"""
-            idx, skiped_word = self.unicode_idx(line)
-            if idx < 0:
-                return line, ''
-            _LOGGER.debug("Ignoring unicode '%s' from: '%s'", skiped_word, line)
-            words = line.split(' ')
-            return ' '.join(words[:idx]), ' '.join(words[idx+1:])
-        def add_remaining_words(line):
-            """Add all remaining words into list."""
-            while len(line.split(' ')) > TOKENS_MIN_LENGTH:
-                words, line = get_token(line)
-                try:
-                    add(words)
-                except TextNotFoundException:
-                    _LOGGER.debug("Skipping '%s' as it was not found", words)
-
-        for i, line in enumerate(text.split('\n')):
-            line = line.rstrip()
-            if i == 0:
-                # first few words
-                if self.unicode_idx(line)[0] != -1 and self.unicode_idx(line)[0] <= 3:
-                    raise FallbackFailedException("Escaped character too close to beginning tokens")
-                words, line = get_token(line)
-                add(words)
-                add_remaining_words(line)
-            else:
-                add_remaining_words(line)
-        merged = self.merge_tokens(tokens)
+        index = self.page_index(page_num)
+        spans = index.fuzzy_find(text)
+        if not spans:
+            raise FallbackFailedException("No close enough result found: {}".format(text))
+        if len(spans) > 1:
+            raise MultipleInstancesException(
+                "Possible multiple search results. Found {} close results".format(len(spans)))
+        tokens = index.span_rects(*spans[0])
+        merged = self.merge_tokens(tokens, index.layout())
         return self.invert_coordinates(merged, self.page_height(page_num))
 
     def annot_exists(self, page_num, annot):
         """Given an annot in pdfrw, determine if it already exists by utilising fitz."""
-        page = self.doc[page_num]
-        page_annot = page.firstAnnot
+        return self.points_exist(page_num, pdfrw_quadpoint_to_fitz_rect(annot.QuadPoints))
+
+    def annot_index(self, page_num):
+        """Return the spatial index of the existing annots of given page, built once and cached."""
+        if page_num not in self._annot_indexes:
+            grid = RectGrid()
+            page = self.doc[page_num]
+            page_annot = page.firstAnnot
+            while page_annot:
+                grid.insert(page_annot.rect)
+                page_annot = page_annot.next                    # get next annot on page
+            self._annot_indexes[page_num] = grid
+        return self._annot_indexes[page_num]
+
+    def _pending_rects(self, page_num, points):
+        """Return the given quadpoints as fitz rects."""
         # need to change pdfrw's rect coor to fits fitz's coordinate *by inverting)
-        pending_annots = [fitz.Rect(x) for x in self.invert_coordinates(
-            pdfrw_quadpoint_to_fitz_rect(annot.QuadPoints), self.page_height(page_num))]
+        return self.invert_coordinates(points, self.page_height(page_num)).to_fitz()
+
+    def points_exist(self, page_num, points):
+        """Given quadpoints in pdf coordinates, determine if an annot already covers them."""
+        with self.stats.timer('duplicate_check'):
+            return self._points_exist(page_num, points)
+
+    def _points_exist(self, page_num, points):
+        """Implementation of points_exist."""
+        grid = self.annot_index(page_num)
+        pending_annots = self._pending_rects(page_num, points)
         """We consider the two given annots are the same if all the sub-parts of the pending
         annots intersects one of the annot that we are checking. (We cannot simply use
         contains because the coordinates data are slightly off and hence unreliable)"""
-        while page_annot:
-            # inverted
-            if all(page_annot.rect.intersects(a) for a in pending_annots):
+        if not pending_annots:
+            return len(grid) > 0 or page_num in self._added_indexes
+        # only the annots around the first sub-part can intersect all of them
+        for page_annot in grid.query(pending_annots[0]):
+            if all(page_annot.intersects(a) for a in pending_annots):
                 return True
-            # else we continue to check next annot
-            page_annot = page_annot.next                        # get next annot on page
-
+        # the highlights added since are known line by line, only the same lines are the same
+        added = self._added_indexes.get(page_num)
+        if added is not None:
+            for lines in added.query(pending_annots[0]):
+                if len(lines) == len(pending_annots) and all(
+                        overlap_ratio(line, rect) >= SAME_HIGHLIGHT_OVERLAP
+                        for line, rect in zip(lines, pending_annots)):
+                    return True
         return False
 
+    def register_points(self, page_num, points):
+        """Register a newly added annot of the given quadpoints for later duplicate checks."""
+        pending_annots = self._pending_rects(page_num, points)
+        if not pending_annots:
+            return
+        lines = tuple(fitz.Rect(rect) for rect in pending_annots)
+        added = self._added_indexes.setdefault(page_num, RectGrid())
+        for line in lines:
+            added.insert(line, lines)
+
     def page_height(self, page_num):
         """Return the page height of given page."""
-        page = self.doc[page_num]
-        return page.bound().y1
+        if page_num not in self._page_heights:
+            page = self.doc[page_num]
+            self._page_heights[page_num] = page.bound().y1
+        return self._page_heights[page_num]
+
+    @staticmethod
+    def sameline(l1, l2):
+        """Determine if the rects of l1 and l2 (arrays of rects) are on the same line"""
+        tol = SAME_LINE_TOL
+        return ((np.abs(l1[..., 1] - l2[..., 1]) < tol) &
+                (np.abs(l1[..., 3] - l2[..., 3]) < tol))
 
     @staticmethod
-    def merge_tokens(annot_tokens):
-        """Try to merge the broken tokens together, with full line width"""
-        if len(annot_tokens) < 2:
+    def merge_tokens(annot_tokens, layout=None):
+        """
+        Try to merge the broken tokens together, with full line width. The tokens are split
+        into the columns of the given page layout, if any.
+        """
+        tokens = RectBatch(annot_tokens)
+        if len(tokens) < 2:
             # no need to merge len = 1
-            return annot_tokens
-        def sameline(l1, l2):
-            """Determine if l1 and l2 are on the same line"""
-            tol = SAME_LINE_TOL
-            if (abs(l1.y0 - l2.y0) < tol and
-                    abs(l1.y1 - l2.y1) < tol):
-                return True
-            return False
+            return tokens
+        sameline = PDFTextSearch.sameline
         def merge_column_tokens(tokens):
-            """Loop through to find left most & right most boarder."""
-            left_most = float('inf')
-            right_most = 0
-            for t in tokens:
-                left_most = min(left_most, t.x0, t.x1)
-                right_most = max(right_most, t.x0, t.x1)
-            lines = []
-            for i, t in enumerate(tokens):
-                if i == 0:
-                    lines.append([t])  # first line no need to check previous line
-                else:
-                    # determine if it's same line as before
-                    if sameline(lines[-1][0], t):
-                        # append to previous line
-                        lines[-1].append(t)
-                    else:
-                        # create a new line
-                        lines.append([t])
+            """Find left most & right most boarder, then merge the tokens of each line."""
+            left_most = min(float('inf'), tokens[:, [0, 2]].min())
+            right_most = max(0, tokens[:, [0, 2]].max())
+            # a token starts a new line when it is not on the same line as the first token
+            # of the current line
+            line_starts = [0]
+            while True:
+                start = line_starts[-1]
+                same = sameline(tokens[start], tokens[start+1:])
+                if same.all():
+                    break
+                line_starts.append(start + 1 + int(np.argmin(same)))
             ###########################
             ## NOW WE DO THE MERGING ##
             ###########################
-            new_lines = []
-            for i, line in enumerate(lines):
-                bot = float('inf')
-                top = 0
-                for l in line:
-                    bot = min(bot, l.y0)
-                    top = max(top, l.y1)
-                if i == 0:
-                    new_lines.append(fitz.Rect(line[0].x0, bot, right_most, top))
-                elif i == len(lines) - 1:
-                    new_lines.append(fitz.Rect(left_most, bot, line[-1].x1, top))
-                else:
-                    new_lines.append(fitz.Rect(left_most, bot, right_most, top))
+            new_lines = np.empty((len(line_starts), 4))
+            new_lines[:, 0] = left_most
+            new_lines[:, 1] = np.minimum.reduceat(tokens[:, 1], line_starts)
+            new_lines[:, 2] = right_most
+            new_lines[:, 3] = np.maximum(np.maximum.reduceat(tokens[:, 3], line_starts), 0)
+            new_lines[0, 0] = tokens[0, 0]
+            if len(line_starts) > 1:
+                new_lines[-1, 2] = tokens[-1, 2]
             return new_lines
 
-        # detect if the highlights spans a double column
-        is_double_column = False
-        double_column = [[], []]
-        double_column[0].append(annot_tokens[0])
-
-        # filter the tokens that belong to different columns, and perform merge for each column
-        for i in range(1, len(annot_tokens)):
-            if not sameline(annot_tokens[i-1], annot_tokens[i]):
-                if annot_tokens[i-1].y0 > annot_tokens[i].y0:
-                    is_double_column = True
-            if not is_double_column:
-                double_column[0].append(annot_tokens[i])
-            else:
-                double_column[1].append(annot_tokens[i])
-        if not is_double_column:
-            return merge_column_tokens(annot_tokens)
-
-        firstcol_merged_tokens = merge_column_tokens(double_column[0])
-        secondcol_merged_tokens = merge_column_tokens(double_column[1])
-        firstcol_merged_tokens.extend(secondcol_merged_tokens)
-        return firstcol_merged_tokens
+        # detect if the highlights spans several columns, every new column starts at a line
+        # break that goes back up, or at a token in another column of the layout
+        tokens = tokens.array
+        line_breaks = ~sameline(tokens[:-1], tokens[1:])
+        new_column = line_breaks & (tokens[:-1, 1] > tokens[1:, 1])
+        if layout is not None and layout.column_count > 1:
+            columns = layout.columns_of(tokens)
+            new_column |= line_breaks & (columns[:-1] != columns[1:])
+        if not new_column.any():
+            return RectBatch(merge_column_tokens(tokens))
+
+        # perform merge for each column
+        splits = np.flatnonzero(new_column) + 1
+        return RectBatch(np.vstack([merge_column_tokens(column_tokens)
+                                    for column_tokens in np.split(tokens, splits)]))
 
     @staticmethod
     def invert_coordinates(rects, page_height):
@@ -232,17 +291,9 @@ class PDFTextSearch:
         """
         # convert from top left bot right -- to -- bot left top right
         # this is for compliance of convention in PDF
-        rects = [(r.x0, r.y1, r.x1, r.y0) for r in rects]
+        rects = RectBatch(rects).array[:, [0, 3, 2, 1]]
         # the coordinate system in fitz and pdfrw are inverted.
         # Need to invert back with "page_height - y"
         # this is for converting between fitz and pdfrw system
-        return [(r[0], page_height - r[1], r[2], page_height - r[3]) for r in rects]
-
-    @staticmethod
-    def unicode_idx(text):
-        """Return the index of word (within the line) that contain escape char \\x"""
-        text = repr(text)[1:-1]
-        for i, word in enumerate(text.split(' ')):
-            if "\\x" in word:
-                return i, word
-        return -1, None
+        rects[:, [1, 3]] = page_height - rects[:, [1, 3]]
+        return RectBatch(rects)
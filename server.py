@@ -0,0 +1,114 @@
+"""
+For converting files within a long running process, so that the interpreter start up, the
+imports and the text extraction of the recently converted files are only paid once. Jobs are
+received one at a time over a unix socket, from client.py.
+"""
+import os
+import io
+import json
+import socket
+import logging
+import contextlib
+from colorlog import ColoredFormatter
+
+import main
+from document_cache import DocumentCache
+
+_LOGGER = logging.getLogger()
+
+
+class ConversionServer:
+    """Represent a server that runs the jobs sent to a unix socket, with one document cache."""
+
+    def __init__(self, socket_path, cache_bytes):
+        self.socket_path = socket_path
+        self.cache = DocumentCache(cache_bytes)
+
+    def in_use(self):
+        """Determine if another server is listening on the socket."""
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            return False
+        finally:
+            probe.close()
+        return True
+
+    def serve_forever(self):
+        """Accept and run jobs until interrupted. Return the exit status."""
+        if os.path.exists(self.socket_path):
+            if self.in_use():
+                _LOGGER.error("Another server is already listening on %s.", self.socket_path)
+                return 1
+            # left behind by a server that was killed
+            os.remove(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        listener.listen()
+        print('Listening on {}'.format(self.socket_path))
+        try:
+            while True:
+                conn, _ = listener.accept()
+                with conn:
+                    try:
+                        self.handle(conn)
+                    except OSError as err:  # the client went away
+                        _LOGGER.warning("Lost connection with client: %s", err)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            os.remove(self.socket_path)
+        return 0
+
+    def handle(self, conn):
+        """Run the job sent through the given connection, and send back its result."""
+        with conn.makefile('rwb') as stream:
+            line = stream.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line.decode('utf-8'))
+                argv, cwd = request['argv'], request['cwd']
+            except (ValueError, KeyError, TypeError) as err:  # not sent by client.py
+                _LOGGER.warning("Malformed request: %s", err)
+                response = {'status': 2, 'output': 'Malformed request: {}\n'.format(err)}
+                stream.write(json.dumps(response).encode('utf-8') + b'\n')
+                return
+            status, output = self.run_job(argv, cwd)
+            stream.write(json.dumps({'status': status, 'output': output}).encode('utf-8') + b'\n')
+        _LOGGER.debug("Ran %s: status %s, %d document(s) cached (%d hits, %d misses)",
+                      argv, status, len(self.cache), self.cache.hits,
+                      self.cache.misses)
+
+    def run_job(self, argv, cwd):
+        """
+        Run the given command line arguments, relative to cwd. Return the exit status, and
+        everything that was printed or logged.
+        """
+        buffer = io.StringIO()
+        channel = logging.StreamHandler(buffer)
+        channel.setFormatter(ColoredFormatter(main.LOGFORMAT))
+        handlers, level = _LOGGER.handlers, _LOGGER.level
+        _LOGGER.handlers = [channel]
+        try:
+            with contextlib.redirect_stdout(buffer), contextlib.redirect_stderr(buffer):
+                try:
+                    args = main.parse_args(argv, cwd=cwd)
+                    _LOGGER.setLevel(logging.DEBUG if args['verbose'] else logging.ERROR)
+                    if args['server'] or args['watch']:
+                        _LOGGER.error("The server cannot run --server or --watch.")
+                        status = 1
+                    else:
+                        status = main.run(args, cache=self.cache)
+                except SystemExit as err:  # invalid arguments, or --help
+                    status = err.code if isinstance(err.code, int) else int(err.code is not None)
+                except Exception:  # one bad job must not stop the server
+                    _LOGGER.exception("Failed to run %s", argv)
+                    status = 1
+        finally:
+            _LOGGER.handlers = handlers
+            _LOGGER.setLevel(level)
+        return status, buffer.getvalue()
@@ -0,0 +1,163 @@
+"""
+For writing the resolved highlights of a pdf into a sidecar file next to it (XFDF, or compact
+json) instead of rewriting the pdf, and reading them back to apply them to the pdf later.
+"""
+import os
+import json
+import xml.etree.ElementTree as ET
+
+from fsutil import write_aside
+
+JSON_SUFFIX = '.highlights.json'
+XFDF_SUFFIX = '.xfdf'
+SIDECAR_FORMATS = {'json': JSON_SUFFIX, 'xfdf': XFDF_SUFFIX}
+XFDF_NAMESPACE = 'http://ns.adobe.com/xfdf/'
+# decimals kept of the coordinates, a hundredth of a point is far below what can be seen
+PRECISION = 2
+
+
+class SidecarFormatException(Exception):
+    """Exception for a sidecar file that cannot be parsed."""
+    pass
+
+
+class SidecarHighlight:
+    """
+    Represent a highlight of a sidecar: its page (0-based), the quadpoints of every line (in
+    pdf coordinates), the highlighted text (not kept by XFDF), comment, author and color.
+    """
+    __slots__ = ('page', 'quads', 'text', 'comment', 'author', 'color')
+
+    def __init__(self, page, quads, text='', comment=None, author=None, color=None):
+        self.page = page
+        self.quads = quads
+        self.text = text
+        self.comment = comment
+        self.author = author
+        self.color = color
+
+
+def sidecar_path(pdf_path, sidecar_format):
+    """Return the path of the sidecar of the given format, for the given pdf."""
+    return os.path.splitext(pdf_path)[0] + SIDECAR_FORMATS[sidecar_format]
+
+
+def find_sidecar(pdf_path):
+    """Return the path of the existing sidecar of the given pdf, or None."""
+    for sidecar_format in SIDECAR_FORMATS:
+        path = sidecar_path(pdf_path, sidecar_format)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _round(quads):
+    """Return the given quadpoints rounded to PRECISION."""
+    return [[round(coord, PRECISION) for coord in quad] for quad in quads]
+
+
+def _bound(quads):
+    """Return the rect (x0, y0, x1, y1) that bounds all the given quadpoints."""
+    xs = [coord for quad in quads for coord in quad[0::2]]
+    ys = [coord for quad in quads for coord in quad[1::2]]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def write_json(path, pdf_path, highlights):
+    """Write the highlights as compact json."""
+    content = {
+        'pdf': os.path.basename(pdf_path),
+        'highlights': [{
+            'page': highlight.page,
+            'quads': _round(highlight.quads),
+            'text': highlight.text,
+            'comment': highlight.comment,
+            'author': highlight.author,
+            'color': highlight.color,
+        } for highlight in highlights],
+    }
+    data = json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    write_aside(path, lambda tmp_path: _write_bytes(tmp_path, data))
+
+
+def write_xfdf(path, pdf_path, highlights):
+    """Write the highlights as XFDF, which most pdf viewers can import."""
+    root = ET.Element('xfdf', {'xmlns': XFDF_NAMESPACE, 'xml:space': 'preserve'})
+    annots = ET.SubElement(root, 'annots')
+    for highlight in highlights:
+        quads = _round(highlight.quads)
+        attributes = {
+            'page': str(highlight.page),
+            'rect': ','.join(str(coord) for coord in _bound(quads)),
+            'coords': ','.join(str(coord) for quad in quads for coord in quad),
+            'flags': 'print',
+        }
+        if highlight.author:
+            attributes['title'] = highlight.author
+        if highlight.color:
+            attributes['color'] = '#' + ''.join(
+                '{:02X}'.format(round(channel * 255)) for channel in highlight.color)
+        element = ET.SubElement(annots, 'highlight', attributes)
+        if highlight.comment:
+            ET.SubElement(element, 'contents').text = highlight.comment
+    ET.SubElement(root, 'f', {'href': os.path.basename(pdf_path)})
+    data = ET.tostring(root, encoding='utf-8', xml_declaration=True)
+    write_aside(path, lambda tmp_path: _write_bytes(tmp_path, data))
+
+
+def _write_bytes(path, data):
+    """Write the given bytes to path."""
+    with open(path, 'wb') as sidecar_file:
+        sidecar_file.write(data)
+
+
+def write_sidecar(path, pdf_path, highlights):
+    """Write the highlights of the given pdf, in the format given by the suffix of path."""
+    if path.endswith(XFDF_SUFFIX):
+        write_xfdf(path, pdf_path, highlights)
+    else:
+        write_json(path, pdf_path, highlights)
+
+
+def read_json(path):
+    """Return the highlights of a json sidecar."""
+    with open(path, 'rb') as sidecar_file:
+        content = json.loads(sidecar_file.read().decode('utf-8'))
+    try:
+        return [SidecarHighlight(item['page'], item['quads'], item.get('text') or '',
+                                 item.get('comment'), item.get('author'),
+                                 tuple(item['color']) if item.get('color') else None)
+                for item in content['highlights']]
+    except (KeyError, TypeError) as err:
+        raise SidecarFormatException("Invalid json sidecar {}: {}".format(path, err))
+
+
+def read_xfdf(path):
+    """Return the highlights of an XFDF sidecar, other kinds of annotation are ignored."""
+    try:
+        root = ET.parse(path).getroot()
+    except ET.ParseError as err:
+        raise SidecarFormatException("Invalid XFDF sidecar {}: {}".format(path, err))
+    highlights = []
+    for element in root.iter('{{{}}}highlight'.format(XFDF_NAMESPACE)):
+        try:
+            coords = [float(coord) for coord in element.get('coords').split(',')]
+            page = int(element.get('page'))
+        except (AttributeError, ValueError) as err:
+            raise SidecarFormatException("Invalid highlight in {}: {}".format(path, err))
+        color = element.get('color')
+        if color:
+            color = tuple(int(color[i:i+2], 16) / 255 for i in (1, 3, 5))
+        contents = element.find('{{{}}}contents'.format(XFDF_NAMESPACE))
+        highlights.append(SidecarHighlight(
+            page, [coords[i:i+8] for i in range(0, len(coords), 8)],
+            comment=contents.text if contents is not None else None,
+            author=element.get('title'), color=color))
+    return highlights
+
+
+def read_sidecar(path):
+    """Return the highlights of the given sidecar, in the format given by its suffix."""
+    if path.endswith(XFDF_SUFFIX):
+        return read_xfdf(path)
+    return read_json(path)
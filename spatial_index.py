@@ -0,0 +1,60 @@
+"""
+For looking up the rects of a pdf page that overlap a given rect, without scanning them all.
+"""
+import math
+from collections import defaultdict
+
+CELL_SIZE = 48
+
+
+class RectGrid:
+    """
+    Represent a uniform grid over a page, where each cell holds the rects overlapping it. A
+    query only looks at the rects registered in the cells covered by the queried rect.
+    """
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.rects = []
+        self.items = []
+        self.cells = defaultdict(list)
+
+    def __len__(self):
+        return len(self.rects)
+
+    def _cells(self, rect):
+        """Yield the keys of all the cells covered by the given rect."""
+        size = self.cell_size
+        for col in range(math.floor(rect.x0 / size), math.floor(rect.x1 / size) + 1):
+            for row in range(math.floor(rect.y0 / size), math.floor(rect.y1 / size) + 1):
+                yield col, row
+
+    def insert(self, rect, item=None):
+        """Register the given rect, along with the item that it stands for (the rect itself)."""
+        idx = len(self.rects)
+        self.rects.append(rect)
+        self.items.append(rect if item is None else item)
+        for cell in self._cells(rect):
+            self.cells[cell].append(idx)
+
+    def query(self, rect):
+        """
+        Return the items of the registered rects that intersect the given rect, in insertion
+        order.
+        """
+        candidates = set()
+        for cell in self._cells(rect):
+            candidates.update(self.cells.get(cell, ()))
+        return [self.items[i] for i in sorted(candidates) if self.rects[i].intersects(rect)]
+
+
+def overlap_ratio(rect1, rect2):
+    """Return the area of the intersection of the given rects over the area of their union."""
+    inter = fitz_area(rect1 & rect2) if rect1.intersects(rect2) else 0.0
+    union = fitz_area(rect1) + fitz_area(rect2) - inter
+    return inter / union if union > 0 else 1.0
+
+
+def fitz_area(rect):
+    """Return the area of the given rect, 0 if it is empty."""
+    return max(0.0, rect.x1 - rect.x0) * max(0.0, rect.y1 - rect.y0)
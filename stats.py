@@ -0,0 +1,129 @@
+"""
+For measuring the wall time of each stage of a conversion, counting its outcomes and keeping
+the peak of its gauges (e.g. memory).
+"""
+import json
+import time
+from collections import defaultdict
+
+
+class _StageTimer:
+    """Context manager that adds its wall time to a stage."""
+    __slots__ = ('seconds', 'stage', 'start')
+
+    def __init__(self, seconds, stage):
+        self.seconds = seconds
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds[self.stage] += time.perf_counter() - self.start
+        return False
+
+
+class Stats:
+    """Represent the wall time spent in every stage, the counters and gauges of a conversion."""
+    enabled = True
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.peaks = {}
+
+    def timer(self, stage):
+        """Return a context manager that adds its wall time to the given stage."""
+        return _StageTimer(self.seconds, stage)
+
+    def incr(self, counter, amount=1):
+        """Increase the given counter."""
+        self.counts[counter] += amount
+
+    def peak(self, gauge, value):
+        """Keep the given value of the gauge if it is higher than the previous ones."""
+        self.peaks[gauge] = max(value, self.peaks.get(gauge, value))
+
+    def merge(self, stats):
+        """
+        Add the stats (as returned by as_dict) of a part of this conversion that was done
+        elsewhere, e.g. in a worker process. The seconds of the stages done in parallel hence
+        add up to more than the wall time.
+        """
+        for stage, seconds in stats['seconds'].items():
+            self.seconds[stage] += seconds
+        for counter, amount in stats['counts'].items():
+            self.counts[counter] += amount
+        for gauge, value in stats['peaks'].items():
+            self.peak(gauge, value)
+
+    def as_dict(self):
+        """Return the stats as a json serialisable dict."""
+        return {'seconds': dict(self.seconds), 'counts': dict(self.counts),
+                'peaks': dict(self.peaks)}
+
+
+class _NoTimer:
+    """Context manager that does nothing."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullStats:
+    """Represent disabled stats, where every hook is a no-op."""
+    enabled = False
+    _NO_TIMER = _NoTimer()
+
+    def timer(self, stage):
+        """Return a context manager that does nothing."""
+        return self._NO_TIMER
+
+    def incr(self, counter, amount=1):
+        """Do nothing."""
+
+    def peak(self, gauge, value):
+        """Do nothing."""
+
+    def merge(self, stats):
+        """Do nothing."""
+
+    def as_dict(self):
+        """Return empty stats."""
+        return {'seconds': {}, 'counts': {}, 'peaks': {}}
+
+
+NULL_STATS = NullStats()
+
+
+class StatsReport:
+    """Represent the stats of every converted file, and their total."""
+
+    def __init__(self):
+        self.files = {}
+
+    def add(self, file_name, stats):
+        """Add the stats (as returned by Stats.as_dict) of the given file."""
+        self.files[file_name] = stats
+
+    def total(self):
+        """Return the sum of the stats of all the files, and the peak of their gauges."""
+        total = {'seconds': defaultdict(float), 'counts': defaultdict(int), 'peaks': {}}
+        for stats in self.files.values():
+            for kind in ('seconds', 'counts'):
+                for key, value in stats[kind].items():
+                    total[kind][key] += value
+            for key, value in stats.get('peaks', {}).items():
+                total['peaks'][key] = max(value, total['peaks'].get(key, value))
+        return {kind: dict(values) for kind, values in total.items()}
+
+    def write(self, path):
+        """Write the report as json."""
+        with open(path, 'w') as report_file:
+            json.dump({'files': self.files, 'total': self.total()}, report_file, indent=2)
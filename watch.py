@@ -0,0 +1,154 @@
+"""
+For watching a library, and converting the annotations appended to its annotation files.
+"""
+import os
+import time
+import logging
+
+from boox_annot_reader import (
+    END_OF_ANNOT,
+    AnnotationFormatException,
+    annotation_path,
+    annotation_pdf_path,
+    read_new_annotations,
+)
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+_LOGGER = logging.getLogger()
+
+ANNOTATION_SUFFIX = '-annotation.txt'
+
+
+class AnnotationWatcher:
+    """
+    Represent a watcher of the annotation files of a directory. For every annotation file, the
+    byte offset and the number of annotations already processed are kept in the manifest, so
+    that only the newly appended annotations are handed to convert_func(pdf, annotations).
+    """
+
+    def __init__(self, root, manifest, convert_func, poll_interval=2.0):
+        self.root = root
+        self.manifest = manifest
+        self.convert_func = convert_func
+        self.poll_interval = poll_interval
+
+    def annotation_files(self):
+        """Return the annotation files of all the pdf within the directory."""
+        return [annotation_path(os.path.join(self.root, file))
+                for file in os.listdir(self.root) if file.endswith('.pdf')]
+
+    @staticmethod
+    def ends_annotation(annotation_file_name, offset):
+        """Determine if the given offset of the annotation file is right after an annotation."""
+        if offset == 0:
+            return True
+        marker = END_OF_ANNOT.encode('utf-8')
+        start = max(0, offset - len(marker) - 2)
+        with open(annotation_file_name, 'rb') as annot_file:
+            annot_file.seek(start)
+            tail = annot_file.read(offset - start)
+        return tail.rstrip(b'\r\n').endswith(marker)
+
+    def process(self, annotation_file_name):
+        """Convert the annotations appended to the given annotation file since last time."""
+        pdf_path = annotation_pdf_path(annotation_file_name)
+        if not os.path.isfile(pdf_path) or not os.path.isfile(annotation_file_name):
+            return
+        offset, count = self.manifest.watch_state(annotation_file_name)
+        if (os.path.getsize(annotation_file_name) < offset or
+                not self.ends_annotation(annotation_file_name, offset)):
+            # the file was rewritten (e.g. an earlier note was edited), start over (the
+            # existing highlights are skipped anyway)
+            _LOGGER.info("%s was rewritten, rescanning its %d annotations",
+                         os.path.basename(annotation_file_name), count)
+            offset, count = 0, 0
+        try:
+            annotations, end = read_new_annotations(annotation_file_name, offset)
+        except AnnotationFormatException as err:
+            if offset == 0:
+                _LOGGER.error("Cannot parse %s: %s", annotation_file_name, err)
+                return
+            # rewritten such that the offset still ends an annotation, start over
+            _LOGGER.info("%s was rewritten, rescanning its %d annotations",
+                         os.path.basename(annotation_file_name), count)
+            offset, count = 0, 0
+            try:
+                annotations, end = read_new_annotations(annotation_file_name, offset)
+            except AnnotationFormatException as err:
+                _LOGGER.error("Cannot parse %s: %s", annotation_file_name, err)
+                return
+        if annotations:
+            _LOGGER.info("%s: %d new annotations", os.path.basename(pdf_path), len(annotations))
+            try:
+                self.convert_func(pdf_path, annotations)
+            except Exception:  # keep watching, these annotations are retried on next change
+                _LOGGER.exception("Failed to convert %s", pdf_path)
+                return
+        self.manifest.set_watch_state(annotation_file_name, end, count + len(annotations))
+
+    def run(self):
+        """Watch the directory until interrupted, with inotify if available."""
+        for annotation_file_name in self.annotation_files():
+            # catch up with what was appended while not watching
+            self.process(annotation_file_name)
+        if INotify is None:
+            _LOGGER.debug("inotify_simple is not installed, polling every %ss.",
+                          self.poll_interval)
+            self._run_polling()
+        else:
+            self._run_inotify()
+
+    def _run_polling(self):
+        """Detect changed annotation files by polling their size and modification time."""
+        # the files that exist now were caught up with by run
+        seen = {}
+        for annotation_file_name in self.annotation_files():
+            try:
+                stat = os.stat(annotation_file_name)
+            except FileNotFoundError:
+                continue
+            seen[annotation_file_name] = (stat.st_size, stat.st_mtime_ns)
+        while True:
+            time.sleep(self.poll_interval)
+            for annotation_file_name in self.annotation_files():
+                try:
+                    stat = os.stat(annotation_file_name)
+                except FileNotFoundError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if annotation_file_name in seen:
+                    changed = seen[annotation_file_name] != signature
+                else:
+                    # a new annotation file, e.g. of a newly synced book
+                    changed = stat.st_size > 0
+                if changed:
+                    self.process(annotation_file_name)
+                seen[annotation_file_name] = signature
+
+    def _run_inotify(self):
+        """Detect changed annotation files with inotify."""
+        inotify = INotify()
+        mask = flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO
+        watches = {inotify.add_watch(self.root, mask): self.root}
+        for file in os.listdir(self.root):
+            annot_dir = os.path.join(self.root, file)
+            if os.path.isdir(annot_dir):
+                watches[inotify.add_watch(annot_dir, mask)] = annot_dir
+        while True:
+            changed = set()
+            for event in inotify.read(read_delay=100):
+                path = os.path.join(watches.get(event.wd, ''), event.name)
+                if event.mask & flags.ISDIR and os.path.dirname(path) == self.root:
+                    # a new annotation directory
+                    watches[inotify.add_watch(path, mask)] = path
+                    changed.add(annotation_path(path + '.pdf'))
+                elif path.endswith(ANNOTATION_SUFFIX):
+                    changed.add(path)
+                elif path.endswith('.pdf') and os.path.dirname(path) == self.root:
+                    changed.add(annotation_path(path))
+            for annotation_file_name in changed:
+                self.process(annotation_file_name)